@@ -0,0 +1,59 @@
+#!/usr/bin/python
+"""
+Benchmark of the chunk store (--chunk_store) on a slowly mutating large file.
+
+Each generation inserts, overwrites and deletes a few small ranges of a
+synthetic file and stores it with store_chunked_file, like one incremental
+backup run. Prints bytes written to the chunk store per run, compared with
+the file size that a 7z archive of the whole file would take.
+
+    python benchmarks/bench_chunk_store.py [size_MB] [generations]
+"""
+import sys
+import os
+import random
+import time
+import tempfile
+import shutil
+
+sys.path.insert(0,os.path.join(os.path.dirname(os.path.abspath(__file__)),".."))
+import incbackup
+
+def mutate(data,rnd,n_edits=4,edit_size=4096):
+    data = bytearray(data)
+    for i in range(n_edits):
+        pos = rnd.randrange(len(data))
+        kind = i % 3
+        if kind == 0:    # insert
+            data[pos:pos] = rnd.randbytes(edit_size) if hasattr(rnd,"randbytes") else os.urandom(edit_size)
+        elif kind == 1:  # overwrite
+            data[pos:pos+edit_size] = os.urandom(len(data[pos:pos+edit_size]))
+        else:            # delete
+            del data[pos:pos+edit_size]
+    return(bytes(data))
+
+if __name__ == '__main__':
+    size = int(float(sys.argv[1])*1024*1024) if len(sys.argv)>1 else 64*1024*1024
+    generations = int(sys.argv[2]) if len(sys.argv)>2 else 5
+    incbackup.backup_config = incbackup.backup_config_struct()
+    rnd = random.Random(1)
+    top = tempfile.mkdtemp()
+    try:
+        chunk_folder = top + "/chunks/"
+        src = top + "/large.img"
+        data = os.urandom(size)
+        print("%4s %14s %14s %8s %8s"%("run","file bytes","written","ratio","sec"))
+        for g in range(generations):
+            if g > 0:
+                data = mutate(data,rnd)
+            with open(src,"wb") as f:
+                f.write(data)
+            t = time.perf_counter()
+            sha,written = incbackup.store_chunked_file(src,chunk_folder,False)
+            elapsed = time.perf_counter() - t
+            print("%4d %14d %14d %8.4f %8.2f"%(g,len(data),written,written/len(data),elapsed))
+        incbackup.restore_chunked_file(sha,top + "/restored.img",chunk_folder)
+        with open(top + "/restored.img","rb") as f:
+            assert f.read() == data
+    finally:
+        shutil.rmtree(top)
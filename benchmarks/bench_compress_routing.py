@@ -0,0 +1,132 @@
+#!/usr/bin/python
+"""
+CPU saved and ratio lost by routing compression by sampled contents.
+
+Makes a synthetic tree of about --mb MB: text (with and without extension),
+pdf full of text, encrypted blobs and packed files without extension,
+camera RAWs, jpg, files of a text header and a random body, and small
+files. For each routing it reports
+
+    compressed      files routed to the compressed archive
+    route_sec       time to decide (sampling for "sample")
+    compress_sec    lzma preset 1 (close to 7z -mx1) of the routed files
+    output_MB       compressed size + size of the stored files
+    ratio           output_MB / input
+
+"sample_cached" routes the same files again with the decisions cached by sha.
+pdf is not in the default --nocompress, so sampling decides it.
+
+    python benchmarks/bench_compress_routing.py
+    python benchmarks/bench_compress_routing.py --mb 256 --nocompress jpg,pdf
+"""
+import sys
+import os
+import time
+import random
+import lzma
+import argparse
+import tempfile
+import shutil
+import logging
+import contextlib
+
+sys.path.insert(0,os.path.join(os.path.dirname(os.path.abspath(__file__)),".."))
+import incbackup
+
+WORDS = ["backup","archive","index","restore","folder","file","time","version","%d","sha","size","path"]
+
+def text_bytes(rand,size):
+    out = []
+    n = 0
+    while n < size:
+        w = rand.choice(WORDS)
+        if w == "%d":
+            w = str(rand.randint(0,99999))
+        out.append(w)
+        n += len(w) + 1
+    return(" ".join(out).encode()[:size])
+
+def make_tree(top,total,seed):
+    # returns {path:(size,mtime_ns)}
+    rand = random.Random(seed)
+    kinds = [  # (name,extension,share of bytes,file size,contents)
+        ("text",".txt",0.15,256*1024,"text"),
+        ("log","",0.10,512*1024,"text"),
+        ("doc",".pdf",0.10,1024*1024,"text"),
+        ("blob","",0.15,1024*1024,"random"),
+        ("pack","",0.10,2*1024*1024,"random"),
+        ("raw",".cr2",0.15,4*1024*1024,"random"),
+        ("photo",".jpg",0.15,2*1024*1024,"random"),
+        ("mixed",".dat",0.08,1024*1024,"mixed"),
+        ("small",".bin",0.02,4*1024,"random"),
+        ]
+    file_stat = {}
+    for name,ext,share,size,contents in kinds:
+        for i in range(max(1,int(total*share)//size)):
+            p = "data/%s/%s_%05d%s"%(name,name,i,ext)
+            if contents == "text":
+                data = text_bytes(rand,size)
+            elif contents == "random":
+                data = rand.randbytes(size)
+            else:
+                data = text_bytes(rand,size//4) + rand.randbytes(size - size//4)
+            os.makedirs(os.path.join(top,os.path.dirname(p)),exist_ok=True)
+            with open(os.path.join(top,p),"wb") as f:
+                f.write(data)
+            st = os.stat(os.path.join(top,p))
+            file_stat[p] = (st.st_size,st.st_mtime_ns)
+    return(file_stat)
+
+def route(paths,file_stat):
+    t = time.perf_counter()
+    incbackup.compress_route.route(paths,file_stat)
+    routed = [p for p in paths if incbackup.is_file_to_compress(p)]
+    return(time.perf_counter() - t,routed)
+
+def compress(paths,routed):
+    t = time.perf_counter()
+    output = 0
+    routed = set(routed)
+    for p in paths:
+        with open(p,"rb") as f:
+            data = f.read()
+        output += len(lzma.compress(data,preset=1)) if p in routed else len(data)
+    return(time.perf_counter() - t,output)
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='compression routing by sampled contents')
+    parser.add_argument('--mb', type=int, default=64, help='size of the synthetic tree')
+    parser.add_argument('--nocompress', default="jpg,jpeg,mp3,mp4,zip,7z", help='NOCOMPRESS_EXTNSION')
+    parser.add_argument('--seed', type=int, default=1)
+    args = parser.parse_args()
+    incbackup.logger = logging.getLogger('bklogging')
+    config = incbackup.backup_config_struct()
+    config.NOCOMPRESS_EXTNSION = args.nocompress.split(",")
+    incbackup.backup_config = config
+    top = tempfile.mkdtemp(prefix="incbackup_bench_")
+    prev_dir = os.getcwd()
+    try:
+        file_stat = make_tree(top,args.mb*1024*1024,args.seed)
+        os.chdir(top)
+        paths = list(file_stat.keys())
+        total = sum([s for s,t in file_stat.values()])
+        print("%d files %.1f MB"%(len(paths),total/1e6))
+        print("%14s %10s %10s %12s %10s %8s"%("routing","compressed","route_sec","compress_sec","output_MB","ratio"))
+        for routing in ["extension","sample","sample_cached"]:
+            if routing != "sample_cached":
+                incbackup.compress_route = incbackup.compress_route_struct()
+                incbackup.hash_cache = incbackup.hash_cache_struct()
+            else: # sha known (as after dedup) and decisions of the last run stored
+                with open(os.devnull,"w") as devnull,contextlib.redirect_stdout(devnull):
+                    incbackup.calc_hash_files(paths)
+                incbackup.compress_route.store(incbackup.hash_cache.run_sha)
+                incbackup.compress_route.run_route = {}
+            if routing == "extension":
+                route_sec,routed = 0.0,[p for p in paths if incbackup.is_file_to_compress(p)]
+            else:
+                route_sec,routed = route(paths,file_stat)
+            compress_sec,output = compress(paths,routed)
+            print("%14s %10d %10.3f %12.3f %10.1f %8.3f"%(routing,len(routed),route_sec,compress_sec,output/1e6,output/total))
+    finally:
+        os.chdir(prev_dir)
+        shutil.rmtree(top)
@@ -0,0 +1,153 @@
+#!/usr/bin/python
+"""
+Throughput of the fileinfo.txt reader and writer.
+
+Writes a synthetic fileinfo.txt of N lines (added, updated, touched, deleted
+and moved files in the proportions of a busy backup, some paths with ',')
+and times, in lines per second:
+
+    write           format_fileinfo_line for all lines
+    read            read_fileinfo (parse all rows)
+    archive_list    make_archive_list_for_7z
+    replay          apply_fileinfo to an empty backuped_files_struct
+
+--v1_ratio of the rows have no size/mtime(ns) columns (fileinfo version 1),
+so their time is read from the date column.
+With --legacy, the parser used before read_fileinfo is also timed.
+
+    python benchmarks/bench_fileinfo.py
+    python benchmarks/bench_fileinfo.py 1000000 4000000 --legacy
+"""
+import sys
+import os
+import time
+import random
+import hashlib
+import argparse
+import tempfile
+import shutil
+import logging
+
+sys.path.insert(0,os.path.join(os.path.dirname(os.path.abspath(__file__)),".."))
+import incbackup
+
+def write_fileinfo(fname,lines,v1_ratio,seed):
+    # returns number of lines written
+    rand = random.Random(seed)
+    n_add = int(lines*0.7)
+    paths = []
+    for i in range(n_add):
+        d = i // 50
+        name = "file %d,copy.txt"%i if i%20 == 0 else "file_%08d.dat"%i
+        paths.append("data/folder%03d/sub%03d/%s"%(d%1000,d//1000,name))
+    def stat(i):
+        if rand.random() < v1_ratio:
+            return(None)
+        return((i%100000,1600000000000000000 + i*1000000007))
+    t = 1600000000.0
+    count = 0
+    with open(fname,"wt",encoding="utf8") as f:
+        f.write(incbackup.backup_config.ARCHIVE_FILE_INFO_HEADER)
+        for i,p in enumerate(paths):
+            f.write(incbackup.format_fileinfo_line("",p,t + i,"C" if i%3 else "N",hashlib.sha256(b"%d"%i).digest(),stat(i),"comp_arch_1.7z" if i%7 == 0 else ""))
+        count += len(paths)
+        rest = rand.sample(range(len(paths)),lines - n_add)
+        groups = [("update",0.35),("touch",0.2),("delete",0.15),("move",0.3)]
+        start = 0
+        for kind,ratio in groups:
+            chosen = rest[start:start + int(len(rest)*ratio)] if kind != "move" else rest[start:]
+            start += len(chosen)
+            for i in chosen:
+                p = paths[i]
+                sha = hashlib.sha256(b"u%d"%i).digest()
+                if kind == "update":
+                    f.write(incbackup.format_fileinfo_line(p,p,t + i + 1,"C",sha,stat(i)))
+                elif kind == "touch":
+                    f.write(incbackup.format_fileinfo_line(p,p,t + i + 1,"M",sha,stat(i)))
+                elif kind == "delete":
+                    f.write(incbackup.format_fileinfo_line(p,"",None,"C",None))
+                else:
+                    f.write(incbackup.format_fileinfo_line(p,p.replace("data/","moved/",1),t + i,"C",sha,stat(i)))
+            count += len(chosen)
+    return(count)
+
+def legacy_split(l):
+    # split_including_commma used before read_fileinfo
+    c_org = l.split(",")
+    if len(c_org)<5:
+        return([])
+    c = []
+    for filenames in range(2):
+        c.append(c_org.pop(0))
+        while True:
+            if len(c[-1])==0:
+                break
+            if c[-1][-1] == '"':
+                break
+            c[-1] += ','
+            c[-1] += c_org.pop(0)
+    c += c_org
+    return(c)
+
+def legacy_read(fname):
+    f = open(fname,encoding="utf8")
+    lines = f.read().split("\n")
+    f.close()
+    rows = 0
+    for l in lines[1:]:
+        c = legacy_split(l)
+        if len(c)<5:
+            continue
+        oldpath = incbackup.get_proper_pathname(c[0])
+        newpath = incbackup.get_proper_pathname(c[1])
+        if len(c)>6 and c[6]!="":
+            mtime = int(c[6])/1e9
+        elif len(newpath)>0:
+            mtime = time.mktime(time.strptime(c[2],"%Y/%m/%d-%H:%M:%S"))
+        rows += 1
+    return(rows)
+
+def read_all(fname):
+    rows = 0
+    for row in incbackup.read_fileinfo(fname):
+        rows += 1
+    return(rows)
+
+def replay(fname):
+    backuped_files = incbackup.backuped_files_struct()
+    backuped_files.replayed_archives = []
+    backuped_files.apply_fileinfo("2026010100",incbackup.read_fileinfo(fname))
+    return(len(backuped_files.file_sha))
+
+def timed(func,*args):
+    t = time.perf_counter()
+    ret = func(*args)
+    return(time.perf_counter() - t,ret)
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='fileinfo.txt reader and writer throughput')
+    parser.add_argument('lines', type=int, nargs='*', help='lines of fileinfo.txt (default 1000000)')
+    parser.add_argument('--v1_ratio', type=float, default=0.1, help='ratio of rows without size/mtime(ns)')
+    parser.add_argument('--seed', type=int, default=1)
+    parser.add_argument('--legacy', action="store_true", help='also time the parser used before read_fileinfo')
+    args = parser.parse_args()
+    incbackup.logger = logging.getLogger('bklogging')
+    incbackup.backup_config = incbackup.backup_config_struct()
+    top = tempfile.mkdtemp(prefix="incbackup_bench_")
+    try:
+        print("%10s %14s %10s %14s"%("lines","phase","sec","lines/sec"))
+        for lines in args.lines or [1000000]:
+            fname = os.path.join(top,"fileinfo.txt")
+            phases = [("write",write_fileinfo,(fname,lines,args.v1_ratio,args.seed)),
+                      ("read",read_all,(fname,)),
+                      ("archive_list",incbackup.make_archive_list_for_7z,(fname,)),
+                      ("replay",replay,(fname,))]
+            if args.legacy:
+                phases.insert(2,("read_legacy",legacy_read,(fname,)))
+            for name,func,func_args in phases:
+                incbackup.time2str_cache.clear()
+                incbackup.str2time_cache.clear()
+                elapsed,ret = timed(func,*func_args)
+                print("%10d %14s %10.3f %14.0f"%(lines,name,elapsed,lines/elapsed))
+    finally:
+        shutil.rmtree(top)
@@ -0,0 +1,46 @@
+#!/usr/bin/python
+"""
+Benchmark of move detection in find_difference.
+
+Simulates renaming a folder of N files (every file is deleted under the old
+name and added under the new name with the same sha) and times
+match_moved_files. The time per file should stay flat as N grows.
+
+    python benchmarks/bench_find_difference.py
+    python benchmarks/bench_find_difference.py 100000 200000 400000
+"""
+import sys
+import os
+import time
+import hashlib
+
+sys.path.insert(0,os.path.join(os.path.dirname(os.path.abspath(__file__)),".."))
+import incbackup
+
+def make_rename(n):
+    p_sha = {}
+    add_sha = {}
+    delete_list = []
+    for i in range(n):
+        sha = hashlib.sha256(b"%d"%i).digest()
+        src = "old_folder/sub%03d/file%07d.dat"%(i%1000,i)
+        dst = "new_folder/sub%03d/file%07d.dat"%(i%1000,i)
+        p_sha[src] = sha
+        add_sha[dst] = sha
+        delete_list.append(src)
+    return(p_sha,add_sha,delete_list)
+
+def bench(n):
+    p_sha,add_sha,delete_list = make_rename(n)
+    t = time.perf_counter()
+    move_list,delete_list = incbackup.match_moved_files(p_sha,add_sha,delete_list)
+    elapsed = time.perf_counter() - t
+    assert len(move_list)==n and len(delete_list)==0 and len(add_sha)==0
+    return(elapsed)
+
+if __name__ == '__main__':
+    sizes = [int(a) for a in sys.argv[1:]] or [25000,50000,100000,200000]
+    print("%10s %10s %12s"%("files","sec","usec/file"))
+    for n in sizes:
+        elapsed = bench(n)
+        print("%10d %10.3f %12.3f"%(n,elapsed,elapsed/n*1e6))
@@ -0,0 +1,90 @@
+#!/usr/bin/python
+"""
+Memory of the backuped file index.
+
+Replays synthetic fileinfo.txt rows of N added files (in batches of
+--batch files, each batch as one backup) into backuped_files_struct and
+reports the memory it holds (file records and content_index), measured
+by tracemalloc.
+
+With --legacy, the same files are also stored as the seven {path:value}
+dicts used before the record store, for comparison.
+
+    python benchmarks/bench_index_memory.py
+    python benchmarks/bench_index_memory.py 1000000 5000000 --legacy
+"""
+import sys
+import os
+import time
+import hashlib
+import argparse
+import tracemalloc
+import logging
+
+sys.path.insert(0,os.path.join(os.path.dirname(os.path.abspath(__file__)),".."))
+import incbackup
+
+def make_rows(start,count,files_per_dir):
+    # lines of fileinfo.txt version 2 (without the header line)
+    rows = []
+    for i in range(start,start+count):
+        d = i // files_per_dir
+        path = "data/folder%03d/sub%03d/part%04d/file_%08d.dat"%(d%1000,d//1000%1000,d//1000000,i)
+        mtime_ns = 1700000000000000000 + i*1000000007
+        rows.append(incbackup.format_fileinfo_line("",path,mtime_ns/1e9,"C" if i%3 else "N",hashlib.sha256(b"%d"%i).digest(),(i%100000,mtime_ns)))
+    return(rows)
+
+def apply_legacy(legacy,n,rows):
+    # {path:value} dicts as kept by backuped_files_struct before file_records_struct
+    for oldpath,p,mtime,flag,sha,size,archive_name in incbackup.parse_fileinfo(rows):
+        sha = bytes.fromhex(sha)
+        legacy["file_mtime"][p] = mtime
+        legacy["file_sha"][p] = sha
+        legacy["file_size"][p] = size
+        legacy["file_archive_num"][p] = n
+        legacy["file_is_compressed"][p] = (flag=="C")
+        legacy["file_archive_name"][p] = archive_name
+        legacy["file_org_path"][p] = False
+        legacy["content_index"][sha] = (n,archive_name,legacy["file_is_compressed"][p],p)
+
+def bench(files,batch,files_per_dir,layout):
+    backuped_files = None
+    legacy = None
+    tracemalloc.start()
+    base = tracemalloc.get_traced_memory()[0]
+    t = time.perf_counter()
+    if layout == "records":
+        backuped_files = incbackup.backuped_files_struct()
+        backuped_files.replayed_archives = []
+    else:
+        legacy = dict([(k,{}) for k in ["file_mtime","file_sha","file_size","file_archive_num","file_is_compressed","file_archive_name","file_org_path","content_index"]])
+    for k,start in enumerate(range(0,files,batch)):
+        n = "20260101%02d"%(k%100) if k < 100 else "2026%06d"%k
+        rows = make_rows(start,min(batch,files-start),files_per_dir)
+        if backuped_files is not None:
+            backuped_files.apply_fileinfo(n,incbackup.parse_fileinfo(rows))
+        else:
+            apply_legacy(legacy,n,rows)
+        del rows
+    elapsed = time.perf_counter() - t
+    total = tracemalloc.get_traced_memory()[0] - base
+    tracemalloc.stop()
+    if backuped_files is not None:
+        assert len(backuped_files.file_sha) == files and len(backuped_files.content_index) == files
+    return(total,elapsed)
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='memory of the backuped file index')
+    parser.add_argument('files', type=int, nargs='*', help='number of files (default 1000000 5000000)')
+    parser.add_argument('--batch', type=int, default=100000, help='files in a backup')
+    parser.add_argument('--files_per_dir', type=int, default=50)
+    parser.add_argument('--legacy', action="store_true", help='also measure the {path:value} dicts')
+    args = parser.parse_args()
+    incbackup.logger = logging.getLogger('bklogging')
+    incbackup.backup_config = incbackup.backup_config_struct()
+    layouts = ["records","legacy"] if args.legacy else ["records"]
+    print("%10s %8s %10s %10s %10s"%("files","layout","MB","bytes/file","sec"))
+    for files in args.files or [1000000,5000000]:
+        for layout in layouts:
+            total,elapsed = bench(files,args.batch,args.files_per_dir,layout)
+            print("%10d %8s %10.1f %10.1f %10.2f"%(files,layout,total/1e6,total/files,elapsed))
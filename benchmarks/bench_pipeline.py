@@ -0,0 +1,287 @@
+#!/usr/bin/python
+"""
+Benchmark of the backup pipeline on a synthetic tree.
+
+Makes a source tree in a temporary folder and a history of backups
+(--generations, made by empty mode, so without archives). Between the
+generations some files are renamed, touched, modified, added and deleted.
+After the last change, each phase of a backup is timed separately:
+
+    find_files               scan of the source tree
+    reconstruct_full         replay of all fileinfo.txt
+    reconstruct_checkpoint   load of the checkpoint in index/
+    find_difference          including sha of move and touch candidates
+    make_archive_info_file   including sha of the other files
+    archive                  archiving by a 7z stand-in (zip, made in the temporary folder)
+    restore_plan             make_restore_plan of all files
+    verify_quick/verify_full verify_files
+    verify_archives          test of all archives by the stand-in
+
+The result is printed as json (or written to --json) to compare across commits.
+
+    python benchmarks/bench_pipeline.py
+    python benchmarks/bench_pipeline.py --files 100000 --generations 20 --json result.json
+"""
+import sys
+import os
+import time
+import json
+import random
+import argparse
+import tempfile
+import shutil
+import stat
+import subprocess
+import contextlib
+
+sys.path.insert(0,os.path.join(os.path.dirname(os.path.abspath(__file__)),".."))
+import incbackup
+
+# 7z stand-in. Supports a,x,e,t with @list files and -o, enough for incbackup.
+SEVEN_ZIP_STUB = r'''import sys,os,zipfile
+args = sys.argv[1:]
+cmd,archive = args[0],args[1]
+outdir = "."
+names = []
+for a in args[2:]:
+    if a.startswith("-o"):
+        outdir = a[2:]
+    elif a.startswith("@"):
+        names += [l.strip().strip('"') for l in open(a[1:],encoding="utf8") if l.strip()]
+    elif not a.startswith("-"):
+        names.append(a)
+if cmd == "a":
+    with zipfile.ZipFile(archive + ".001","w",zipfile.ZIP_DEFLATED if "-mx0" not in args else zipfile.ZIP_STORED,compresslevel=1) as z:
+        for p in names:
+            z.write(p,p)
+elif cmd in ("x","e"):
+    with zipfile.ZipFile(archive) as z:
+        for m in (names or z.namelist()):
+            dst = os.path.join(outdir,m if cmd == "x" else os.path.basename(m))
+            os.makedirs(os.path.dirname(dst) or ".",exist_ok=True)
+            with open(dst,"wb") as f:
+                f.write(z.read(m))
+elif cmd == "t":
+    with zipfile.ZipFile(archive) as z:
+        sys.exit(0 if z.testzip() is None else 2)
+'''
+
+def make_seven_zip_stub(folder):
+    script = os.path.join(folder,"7z_stub.py")
+    with open(script,"wt",encoding="utf8") as f:
+        f.write(SEVEN_ZIP_STUB)
+    if os.name == 'posix':
+        stub = os.path.join(folder,"7z")
+        with open(stub,"wt",encoding="utf8") as f:
+            f.write('#!/bin/sh\nexec "%s" "%s" "$@"\n'%(sys.executable,script))
+        os.chmod(stub,os.stat(stub).st_mode | stat.S_IXUSR)
+    else:
+        stub = os.path.join(folder,"7z.cmd")
+        with open(stub,"wt",encoding="utf8") as f:
+            f.write('@"%s" "%s" %%*\n'%(sys.executable,script))
+    return(stub)
+
+class synthetic_tree:
+    def __init__(self,top,args):
+        self.top = top
+        self.args = args
+        self.rand = random.Random(args.seed)
+        self.files = []
+        self.serial = 0
+        self.mtime = 1600000000
+
+    def new_path(self,folder="data"):
+        i = self.serial
+        self.serial += 1
+        d = i // self.args.files_per_dir
+        levels = []
+        for k in range(self.args.depth):
+            levels.append("d%02d"%(d % self.args.fanout))
+            d //= self.args.fanout
+        return("%s/%s/f%07d.%s"%(folder,"/".join(levels),i,self.rand.choice(["txt","c","dat","jpg"])))
+
+    def file_size(self):
+        size = int(self.rand.lognormvariate(0,1.5) * self.args.size_median)
+        return(min(size,self.args.size_max))
+
+    def write(self,p):
+        full = os.path.join(self.top,p)
+        os.makedirs(os.path.dirname(full),exist_ok=True)
+        with open(full,"wb") as f:
+            f.write(self.rand.randbytes(self.file_size()))
+        os.utime(full,(self.mtime,self.mtime))
+
+    def make(self):
+        for i in range(self.args.files):
+            p = self.new_path()
+            self.write(p)
+            self.files.append(p)
+
+    def mutate(self):
+        # one generation of changes. mtime goes 100 sec forward, beyond the 2 sec tolerance of find_difference.
+        self.mtime += 100
+        n = len(self.files)
+        picked = self.rand.sample(range(n),min(n,int(n*(self.args.rename_ratio+self.args.touch_ratio+self.args.modify_ratio+self.args.delete_ratio))))
+        counts = {"renamed":0,"touched":0,"modified":0,"deleted":0,"added":0}
+        deleted = set()
+        k = 0
+        for kind,ratio in [("renamed",self.args.rename_ratio),("touched",self.args.touch_ratio),("modified",self.args.modify_ratio),("deleted",self.args.delete_ratio)]:
+            for i in picked[k:k+int(n*ratio)]:
+                full = os.path.join(self.top,self.files[i])
+                if kind == "renamed":
+                    p = self.new_path("data/moved")
+                    os.makedirs(os.path.dirname(os.path.join(self.top,p)),exist_ok=True)
+                    os.rename(full,os.path.join(self.top,p))
+                    self.files[i] = p
+                elif kind == "touched":
+                    os.utime(full,(self.mtime,self.mtime))
+                elif kind == "modified":
+                    self.write(self.files[i])
+                else:
+                    os.remove(full)
+                    deleted.add(i)
+                counts[kind] += 1
+            k += int(n*ratio)
+        self.files = [p for i,p in enumerate(self.files) if i not in deleted]
+        for i in range(int(n*self.args.add_ratio)):
+            p = self.new_path()
+            self.write(p)
+            self.files.append(p)
+            counts["added"] += 1
+        return(counts)
+
+def setup_config(top,stub):
+    config = incbackup.backup_config_struct()
+    config.src_top = os.path.join(top,"src") + "/"
+    config.dst_top = {"data":[]}
+    config.NOCOMPRESS_EXTNSION = ["jpg"]
+    config.ARCHIVE_FOLDER = os.path.join(top,"dst",config.ARCHIVE_FOLDER_NAME)
+    config.INDEX_FOLDER = os.path.join(top,"dst",config.INDEX_FOLDER_NAME)
+    config.CHUNK_FOLDER = os.path.join(top,"dst",config.CHUNK_FOLDER_NAME)
+    config.WORKDIR = os.path.join(top,"work") + "/"
+    config.DO_BEEP = False
+    for folder in [config.ARCHIVE_FOLDER,config.INDEX_FOLDER,config.WORKDIR]:
+        os.makedirs(folder,exist_ok=True)
+    incbackup.backup_config = config
+    incbackup.SEVEN_ZIP = stub
+    incbackup.change_journal = incbackup.change_journal_struct(config.INDEX_FOLDER)
+    return(config)
+
+def load_backuped_files(config,use_checkpoint):
+    backuped_files = incbackup.create_backup_file_obj(config.ARCHIVE_FOLDER,-1)
+    backuped_files.reconstruct_incremental(config.ARCHIVE_FOLDER,config.ARCHIVE_FILE_INFO_NAME,config.INDEX_FOLDER if use_checkpoint else None)
+    return(backuped_files)
+
+def timed(result,name,func,*args):
+    t = time.perf_counter()
+    with open(os.devnull,"w") as devnull,contextlib.redirect_stdout(devnull):
+        ret = func(*args)
+    result[name] = round(time.perf_counter() - t,4)
+    return(ret)
+
+def git_revision():
+    try:
+        return(subprocess.check_output(["git","rev-parse","--short","HEAD"],cwd=os.path.dirname(os.path.abspath(__file__)),stderr=subprocess.DEVNULL).decode().strip())
+    except (OSError,subprocess.CalledProcessError):
+        return("")
+
+def bench(args,top):
+    stub = make_seven_zip_stub(top)
+    config = setup_config(top,stub)
+    tree = synthetic_tree(config.src_top,args)
+    t = time.perf_counter()
+    tree.make()
+    history = {"make_tree":round(time.perf_counter() - t,4),"changes":[]}
+
+    # history of backups by empty mode
+    incbackup.backuped_files = load_backuped_files(config,True)
+    for g in range(args.generations):
+        if g > 0:
+            history["changes"].append(tree.mutate())
+        incbackup.hash_cache = incbackup.hash_cache_struct()
+        with open(os.devnull,"w") as devnull,contextlib.redirect_stdout(devnull):
+            incbackup.backup("empty")
+    history["changes"].append(tree.mutate())
+
+    phases = {}
+    prev_dir = os.getcwd()
+    os.chdir(config.src_top)
+    try:
+        file_stat = {}
+        current_mtime = timed(phases,"find_files",incbackup.search_target_file_and_get_mtime,config.dst_top,file_stat)
+        timed(phases,"reconstruct_full",load_backuped_files,config,False)
+        backuped_files = timed(phases,"reconstruct_checkpoint",load_backuped_files,config,True)
+        incbackup.backuped_files = backuped_files
+        incbackup.hash_cache = incbackup.hash_cache_struct()
+        a,u,d,m,t = timed(phases,"find_difference",incbackup.find_difference,backuped_files.file_mtime,backuped_files.file_sha,current_mtime,backuped_files.file_size,file_stat)
+        backup_number = incbackup.make_backup_date_number(backuped_files.archive_time)
+        os.mkdir(config.ARCHIVE_FOLDER + backup_number)
+        info_file = config.ARCHIVE_FOLDER + backup_number + "/" + config.ARCHIVE_FILE_INFO_NAME
+        timed(phases,"make_archive_info_file",incbackup.make_archive_info_file,info_file,current_mtime,a,u,d,m,t,file_stat)
+        last_backup = {"added":len(a),"updated":len(u),"deleted":len(d),"moved":len(m),"touched":len(t)}
+        timed(phases,"archive",archive,config,backup_number,info_file)
+        backuped_files.archive_time[backup_number] = incbackup.write_archive_time(config.ARCHIVE_FOLDER + backup_number)
+        backuped_files.apply_fileinfo(backup_number,backuped_files.get_fileinfo_data(config.ARCHIVE_FOLDER,config.ARCHIVE_FILE_INFO_NAME,backup_number))
+    finally:
+        os.chdir(prev_dir)
+    timed(phases,"restore_plan",incbackup.make_restore_plan,[])
+    incbackup.hash_cache = incbackup.hash_cache_struct()
+    quick = timed(phases,"verify_quick",incbackup.verify_files,True)
+    incbackup.hash_cache = incbackup.hash_cache_struct()
+    full = timed(phases,"verify_full",incbackup.verify_files,False)
+    archives = timed(phases,"verify_archives",incbackup.verify_archives)
+    assert quick["ok"] and full["ok"] and archives["ok"]
+    return({
+        "revision":git_revision(),
+        "python":sys.version.split()[0],
+        "params":vars(args),
+        "files":len(tree.files),
+        "bytes":sum([os.path.getsize(os.path.join(config.src_top,p)) for p in tree.files]),
+        "history":history,
+        "last_backup":last_backup,
+        "sec":phases,
+        })
+
+def archive(config,backup_number,info_file):
+    archive_list = incbackup.make_archive_list_for_7z(info_file)
+    for archive_name in archive_list.keys():
+        is_compressed,files = archive_list[archive_name]
+        list_file_name = config.get_backup_temp_filename(backup_number,archive_name)
+        with open(list_file_name,"wt",encoding="utf8") as f:
+            for p in files:
+                f.write("%s\n"%p)
+        success,msg = incbackup.run_7z_archive(config.ARCHIVE_FOLDER + backup_number + archive_name,is_compressed,list_file_name,[])
+        assert success
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='backup pipeline benchmark on a synthetic tree')
+    parser.add_argument('--files', type=int, default=5000, help='files in the first generation')
+    parser.add_argument('--size_median', type=int, default=4096, help='median file size (log normal)')
+    parser.add_argument('--size_max', type=int, default=4*1024*1024)
+    parser.add_argument('--depth', type=int, default=3, help='folder levels')
+    parser.add_argument('--fanout', type=int, default=10, help='sub folders in a folder')
+    parser.add_argument('--files_per_dir', type=int, default=50)
+    parser.add_argument('--generations', type=int, default=5, help='backups before the timed one (up to 98)')
+    parser.add_argument('--rename_ratio', type=float, default=0.01)
+    parser.add_argument('--touch_ratio', type=float, default=0.01)
+    parser.add_argument('--modify_ratio', type=float, default=0.02)
+    parser.add_argument('--delete_ratio', type=float, default=0.005)
+    parser.add_argument('--add_ratio', type=float, default=0.02)
+    parser.add_argument('--seed', type=int, default=1)
+    parser.add_argument('--json', help='write the result to this file')
+    parser.add_argument('--keep', action="store_true", help='keep the temporary folder')
+    args = parser.parse_args()
+
+    top = tempfile.mkdtemp(prefix="incbackup_bench_")
+    try:
+        result = bench(args,top)
+    finally:
+        if args.keep:
+            print("kept %s"%top)
+        else:
+            shutil.rmtree(top)
+    text = json.dumps(result,indent=1)
+    if args.json:
+        with open(args.json,"wt",encoding="utf8") as f:
+            f.write(text)
+    print(text)
@@ -0,0 +1,83 @@
+#!/usr/bin/python
+"""
+Benchmark of the "Scan disk" phase (search_target_file_and_get_mtime).
+
+Makes a synthetic tree in a temporary folder and scans it with a number of
+exclude patterns. Also times matching the scanned paths with the combined
+matcher of compile_reject_patterns against one re.search per pattern.
+
+    python benchmarks/bench_scan.py [files] [patterns] [scan_workers]
+"""
+import sys
+import os
+import re
+import time
+import tempfile
+import shutil
+
+sys.path.insert(0,os.path.join(os.path.dirname(os.path.abspath(__file__)),".."))
+import incbackup
+
+def make_tree(top,n_files,files_per_dir=50):
+    for i in range(n_files):
+        d = os.path.join(top,"src","d%03d"%(i//files_per_dir%100),"d%05d"%(i//files_per_dir))
+        if i%files_per_dir==0:
+            os.makedirs(d,exist_ok=True)
+        with open(os.path.join(d,"f%07d.%s"%(i,["c","h","txt","dat"][i%4])),"wb") as f:
+            f.write(b"x")
+
+def make_patterns(n):
+    ptns = [r"\.obj$",r"\.pch$",r"/build$",r"/\.git$",r"\.log$"]
+    i = 0
+    while len(ptns) < n:
+        ptns.append(r"/tmp%03d$|\.ext%03d$"%(i,i))
+        i += 1
+    return(ptns[:n])
+
+def legacy_match(patterns,paths):
+    n = 0
+    for f in paths:
+        for ptn in patterns:
+            if re.search(ptn,f):
+                n += 1
+                break
+    return(n)
+
+def combined_match(patterns,paths):
+    match = incbackup.compile_reject_patterns(patterns)
+    n = 0
+    for f in paths:
+        if match(f):
+            n += 1
+    return(n)
+
+if __name__ == '__main__':
+    n_files = int(sys.argv[1]) if len(sys.argv)>1 else 20000
+    n_patterns = int(sys.argv[2]) if len(sys.argv)>2 else 40
+    incbackup.backup_config = incbackup.backup_config_struct()
+    if len(sys.argv)>3:
+        incbackup.backup_config.SCAN_WORKERS = int(sys.argv[3])
+    top = tempfile.mkdtemp()
+    prev_dir = os.getcwd()
+    try:
+        make_tree(top,n_files)
+        os.chdir(top)
+        patterns = make_patterns(n_patterns)
+        t = time.perf_counter()
+        mtime = incbackup.search_target_file_and_get_mtime({"src":patterns},{})
+        scan = time.perf_counter() - t
+        paths = list(mtime.keys())
+        t = time.perf_counter()
+        n1 = legacy_match(patterns,paths)
+        legacy = time.perf_counter() - t
+        t = time.perf_counter()
+        n2 = combined_match(patterns,paths)
+        combined = time.perf_counter() - t
+        assert n1 == n2
+        print("files %d, patterns %d, scan workers %d"%(len(paths),n_patterns,incbackup.backup_config.SCAN_WORKERS))
+        print("Scan disk            %8.3f sec (%.0f files/sec)"%(scan,len(paths)/scan))
+        print("match per pattern    %8.3f sec"%legacy)
+        print("match combined       %8.3f sec"%combined)
+    finally:
+        os.chdir(prev_dir)
+        shutil.rmtree(top)
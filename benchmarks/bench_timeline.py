@@ -0,0 +1,147 @@
+#!/usr/bin/python
+"""
+Lookups by the timeline index against replay of fileinfo.txt.
+
+Makes an archive folder of B backups (fileinfo.txt only). The first backup
+adds --files files, each later one updates, touches, moves or deletes
+--changes of them. Times, in seconds:
+
+    build           timeline_struct.sync from an empty index
+    add_backup      one more backup added to the index after a backup
+    state_replay    files at the middle backup by reconstruct_incremental
+    state_index     the same by timeline_struct.load_state
+    path_replay     one path at the middle backup by reconstruct_incremental
+    path_index      the same by load_state with the path
+    history_scan    all versions of one path by reading all fileinfo.txt
+    history_index   the same by timeline_struct.get_versions
+
+    python benchmarks/bench_timeline.py
+    python benchmarks/bench_timeline.py 100 1000 3000 --files 20000
+"""
+import sys
+import os
+import time
+import random
+import hashlib
+import argparse
+import tempfile
+import shutil
+import logging
+
+sys.path.insert(0,os.path.join(os.path.dirname(os.path.abspath(__file__)),".."))
+import incbackup
+
+def backup_number(b):
+    return("2026%02d%04d"%(b//10000+1,b%10000))
+
+def write_history(archive_folder,backups,files,changes,seed):
+    # returns backup numbers, oldest first
+    rand = random.Random(seed)
+    live = ["data/folder%03d/file_%07d.dat"%(i%500,i) for i in range(files)]
+    added = files
+    t = 1700000000.0
+    numbers = []
+    for b in range(backups):
+        n = backup_number(b)
+        os.makedirs(archive_folder + n)
+        lines = [incbackup.backup_config.ARCHIVE_FILE_INFO_HEADER]
+        if b == 0:
+            for p in live:
+                lines.append(incbackup.format_fileinfo_line("",p,t,"C",hashlib.sha256(p.encode()).digest(),(100,int(t*1e9))))
+        else:
+            chosen = rand.sample(range(len(live)),min(changes,len(live)))
+            deleted = set()
+            for i in chosen:
+                p = live[i]
+                r = rand.random()
+                t += 1
+                sha = hashlib.sha256(b"%s %d"%(p.encode(),b)).digest()
+                if r < 0.5:
+                    lines.append(incbackup.format_fileinfo_line(p,p,t,"C",sha,(100,int(t*1e9))))
+                elif r < 0.7:
+                    lines.append(incbackup.format_fileinfo_line(p,p,t,"M",sha,(100,int(t*1e9))))
+                elif r < 0.85:
+                    q = "moved/folder%03d/file_%07d.dat"%(added%500,added)
+                    added += 1
+                    lines.append(incbackup.format_fileinfo_line(p,q,t,"C",sha,None))
+                    live[i] = q
+                else:
+                    lines.append(incbackup.format_fileinfo_line(p,"",None,"C",None))
+                    deleted.add(i)
+            live = [p for i,p in enumerate(live) if i not in deleted]
+            for k in range(len(deleted)): # keep the number of files
+                p = "data/folder%03d/file_%07d.dat"%(added%500,added)
+                added += 1
+                lines.append(incbackup.format_fileinfo_line("",p,t,"C",hashlib.sha256(p.encode()).digest(),(100,int(t*1e9))))
+                live.append(p)
+        with open(archive_folder + n + "/" + incbackup.backup_config.ARCHIVE_FILE_INFO_NAME,"wt",encoding="utf8") as f:
+            f.write("".join(lines))
+        numbers.append(n)
+    return(numbers)
+
+def replay(config,numbers):
+    backuped_files = incbackup.backuped_files_struct()
+    backuped_files.archive_time = dict([(n,0) for n in numbers])
+    backuped_files.reconstruct_incremental(config.ARCHIVE_FOLDER,config.ARCHIVE_FILE_INFO_NAME)
+    return(backuped_files)
+
+def load_state(timeline,n,paths=None):
+    backuped_files = incbackup.backuped_files_struct()
+    timeline.load_state(backuped_files,n,paths)
+    return(backuped_files)
+
+def timed(func,*args):
+    t = time.perf_counter()
+    ret = func(*args)
+    return(time.perf_counter() - t,ret)
+
+def bench(top,backups,args):
+    config = incbackup.backup_config_struct()
+    config.ARCHIVE_FOLDER = os.path.join(top,"archive") + "/"
+    config.INDEX_FOLDER = os.path.join(top,"index") + "/"
+    os.makedirs(config.INDEX_FOLDER)
+    incbackup.backup_config = config
+    numbers = write_history(config.ARCHIVE_FOLDER,backups + 1,args.files,args.changes,args.seed)
+    middle = numbers[len(numbers)//2]
+    result = {}
+    timeline = incbackup.timeline_struct()
+    timeline.open(config.INDEX_FOLDER + config.TIMELINE_FILE_NAME)
+    result["build"],ret = timed(timeline.sync,config.ARCHIVE_FOLDER,config.ARCHIVE_FILE_INFO_NAME,numbers[:-1])
+    # as backup() does, with the state before the last backup
+    last = replay(config,numbers[:-1])
+    changes = {}
+    last.apply_fileinfo(numbers[-1],last.get_fileinfo_data(config.ARCHIVE_FOLDER,config.ARCHIVE_FILE_INFO_NAME,numbers[-1]),changes)
+    signature = last.get_fileinfo_signature(config.ARCHIVE_FOLDER,config.ARCHIVE_FILE_INFO_NAME,numbers[-1])
+    result["add_backup"],ret = timed(timeline.add_backup,numbers[-1],signature,last.files,changes)
+    result["state_replay"],state = timed(replay,config,numbers[:len(numbers)//2+1])
+    result["state_index"],ret = timed(load_state,timeline,middle)
+    assert len(ret.file_sha) == len(state.file_sha)
+    path = sorted(state.file_sha.keys())[0]
+    result["path_replay"],ret = timed(lambda:replay(config,numbers[:len(numbers)//2+1]).file_sha[path])
+    result["path_index"],ret = timed(load_state,timeline,middle,[path])
+    assert ret.file_sha[path] == state.file_sha[path]
+    incbackup.backuped_files = incbackup.create_backup_file_obj(config.ARCHIVE_FOLDER,-1)
+    result["history_scan"],scanned = timed(lambda:list(incbackup.scan_history_versions(set([path]),())))
+    result["history_index"],ret = timed(lambda:list(timeline.get_versions(set([path]),())))
+    assert sorted(ret) == sorted(scanned)
+    timeline.close()
+    return(result)
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='timeline index against replay of fileinfo.txt')
+    parser.add_argument('backups', type=int, nargs='*', help='number of backups after the first (default 100 1000)')
+    parser.add_argument('--files', type=int, default=10000, help='files in the first backup')
+    parser.add_argument('--changes', type=int, default=200, help='changed files in each later backup')
+    parser.add_argument('--seed', type=int, default=1)
+    args = parser.parse_args()
+    incbackup.logger = logging.getLogger('bklogging')
+    incbackup.backup_config = incbackup.backup_config_struct()
+    print("%10s %14s %10s"%("backups","phase","sec"))
+    for backups in args.backups or [100,1000]:
+        top = tempfile.mkdtemp(prefix="incbackup_bench_")
+        try:
+            result = bench(top,backups,args)
+        finally:
+            shutil.rmtree(top)
+        for name,sec in result.items():
+            print("%10d %14s %10.4f"%(backups,name,sec))
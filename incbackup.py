@@ -52,38 +52,101 @@ import shutil
 import traceback
 import stat
 import argparse
+import pickle
+import threading
+import concurrent.futures
+import collections
+import errno
+import signal
+import zlib
+import zipfile
+import struct
+import json
+import array
+import sqlite3
 
 if os.name == 'posix' : # assume ubuntu
     SEVEN_ZIP = "7z"
+    import fcntl
+    FICLONE = 0x40049409  # ioctl to share data blocks of a file (btrfs,xfs)
 else:
     SEVEN_ZIP = "C:/Program Files/7-Zip/7z.exe"
     import winsound
+    fcntl = None
 
 class backup_config_struct:
     def __init__(self):
         self.password = False
         self.mode = None
         self.recovery_files = []
+        self.BACKUP_STOP_FOLDER = set()
         self.RECOVERY_TIME = -1
         self.NOCOMPRESS_EXTNSION = []
         self.ARCHIVE_FILE_COMPRESS = "/comp_arch.7z"
         self.ARCHIVE_FILE_NOCOMPRESS = "/nocomp_arch.7z"
         self.ARCHIVE_FILE_EXT = ".001"
         self.ARCHIVE_FILE_INFO_NAME = "fileinfo.txt"
+        self.ARCHIVE_FILE_INFO_HEADER = "### fileinfo version 2: previous path(blank if new),new path(blank if delete),last modified,C=compress/N=non compress/M=mtime only,sha value,size,last modified(ns),archive(blank for default)\n"
+        self.ARCHIVE_JOBS = 2  ## number of 7z processes run at once
+        self.RESTORE_JOBS = 4  ## number of backup folders extracted at once in restore
+        self.ARCHIVE_ENGINE = "7z"  ## "zip" archives in this process, reading each file once for sha and archive
+        self.COMPRESS_SHARDS = 1  ## split files to compress into this number of archives
+        self.USE_CHUNK_STORE = False  ## store large files in chunks, each chunk only once
+        self.CHUNK_FOLDER_NAME = "chunks/"
+        self.CHUNK_ARCHIVE_NAME = "chunks"  ## archive column of fileinfo.txt for files in the chunk store
+        self.CHUNK_FILE_MIN_SIZE = 64*1024*1024  ## files of this size or larger go to the chunk store
+        self.CHUNK_MIN_SIZE = 256*1024
+        self.CHUNK_MAX_SIZE = 8*1024*1024
+        self.CHUNK_PATTERN_BITS = 20  ## a boundary in about 2**20 bytes after CHUNK_MIN_SIZE
+        self.USE_DEDUP = True  ## do not archive files whose contents are already in some archive
+        self.DEDUP_ARCHIVE_NAME = "ref"  ## archive column of fileinfo.txt for files stored before with the same sha
+        self.MISSING_ARCHIVE_NAME = "missing"  ## archive column made by consolidate for files not in any archive
+        self.CONSOLIDATE_FOLDER_NAME = "consolidate_temp/"  ## in ARCHIVE_FOLDER
+        self.CONSOLIDATE_MARKER_NAME = "consolidate.txt"  ## in INDEX_FOLDER while replacing backups
+        self.CONSOLIDATE_CONTENT_FOLDER_NAME = ".incbackup_contents/"  ## path of contents kept only for ref
+        self.CONSOLIDATE_UPTO = None
         self.PRINT_MAX_FILE_NUM = 100
         self.DO_BEEP = True
         self.OVERWRITE_OPT = []
         self.EXTRACT_METHOD = "x"    
         self.DEFAULT_CONFIG_FILE_NAME = "backup_config.txt"
         self.ARCHIVE_FOLDER_NAME = "archive/"
+        self.INDEX_FOLDER_NAME = "index/"
+        self.STATE_INDEX_PREFIX = "state_"
+        self.STATE_INDEX_EXT = ".pickle"
+        self.STATE_INDEX_KEEP = 3  ## number of checkpoints kept in INDEX_FOLDER
+        self.USE_TIMELINE = True  ## keep versions of each path in INDEX_FOLDER for -t and history
+        self.TIMELINE_FILE_NAME = "timeline.sqlite"
+        self.ARCHIVE_TIME_FILE_NAME = "backup_time.txt"  ## in each backup folder, time of the backup
         self.RESTORE_LIST_FILE = "arhive_list.txt"
+        self.VERIFY_SUMMARY_FILE_NAME = "verify_summary.json"  ## in INDEX_FOLDER
+        self.VERIFY_QUICK = False  ## verify hashes only files whose mtime or size differ from the backup
+        self.VERIFY_ARCHIVES = False  ## verify also tests archives
         self.DELETE_ON_FAIL = False  ## delete not perfect arhive when arhiver failed.
         self.WAIT_SEC_BEFORE_EXIT = 0
+        self.HASH_WORKERS = min(4,os.cpu_count() or 1)  ## threads to calculate sha. 1 means no thread.
+        self.USE_JOURNAL = False  ## find changed files from the journal of watch mode instead of scanning all
+        self.JOURNAL_FILE_NAME = "journal.txt"
+        self.JOURNAL_STATE_FILE_NAME = "journal_state.txt"
+        self.JOURNAL_PID_FILE_NAME = "watcher.pid"
+        self.JOURNAL_MAX_SIZE = 64*1024*1024  ## start new journal (and full scan) when exceeded
+        self.SCAN_WORKERS = 1  ## threads to read directories. 1 means no thread. Larger is faster for network drives.
+        self.USE_HASH_CACHE = True  ## reuse sha of files whose device,inode,size,mtime and ctime are not changed
+        self.HASH_CACHE_FILE_NAME = "hash_cache.pickle"
+        self.HASH_CACHE_MAX_ENTRIES = 500000  ## least recently used entries are dropped
+        self.COMPRESS_ROUTING = "extension"  ## "sample" also decides by trial compression of blocks of each file
+        self.COMPRESS_SAMPLE_BLOCKS = 4  ## blocks read from the start to the end of a file
+        self.COMPRESS_SAMPLE_BLOCK_SIZE = 64*1024
+        self.COMPRESS_SAMPLE_RATIO = 0.9  ## compress if samples shrink below this ratio by zlib level 1
+        self.COMPRESS_SAMPLE_MIN_SIZE = 16*1024  ## smaller files are routed by extension (compressed together in solid archive)
+        self.COMPRESS_ROUTE_CACHE_FILE_NAME = "compress_route.pickle"  ## sha:is_compressed decided by samples
+        self.COMPRESS_ROUTE_CACHE_MAX_ENTRIES = 500000
         if os.name == 'posix' : # assume ubuntu
             self.WORKDIR = "/tmp/incbackuptemp/"
         else:
             self.WORKDIR = "C:/tmp/incbackuptemp/"
-        self.MOVE_TEMP = self.WORKDIR + "extract_temp/"
+        self.RESTORE_STAGING_FOLDER_NAME = ".incbackup_extract_temp/"  ## made in the restore folder for moved files
+        self.RESTORE_HARDLINK = False  ## restore files of the same contents as hard links
 
     def read_config_files(self,conf_file_list):
         tree_top = {}
@@ -120,84 +183,564 @@ class backup_config_struct:
         self.src_top = src
         self.dst_top = tree_top
     
-    def get_backup_temp_filename_comp(self,n):
-        return(self.WORKDIR+"bc_%s.txt"%n)
-    
-    def get_backup_temp_filename_nocomp(self,n):
-        return(self.WORKDIR+"bn_%s.txt"%n)
+    def get_backup_temp_filename(self,n,archive_name):
+        return(self.WORKDIR+"b_%s_%s.txt"%(n,os.path.basename(archive_name)))
 
-    def get_restore_temp_filename_comp(self,n):
-        return(self.WORKDIR+"rc_%s.txt"%n)
-    
-    def get_restore_temp_filename_nocomp(self,n):
-        return(self.WORKDIR+"rn_%s.txt"%n)
+    def get_restore_temp_filename(self,n,archive_name):
+        return(self.WORKDIR+"r_%s_%s.txt"%(n,os.path.basename(archive_name)))
+
+    def get_archive_name(self,is_compressed,archive_name=""):
+        # archive file name in a backup folder. archive_name is the archive column of fileinfo.txt
+        if archive_name != "":
+            return("/"+archive_name)
+        elif is_compressed:
+            return(self.ARCHIVE_FILE_COMPRESS)
+        else:
+            return(self.ARCHIVE_FILE_NOCOMPRESS)
+
+    def get_shard_archive_name(self,k):
+        # comp_arch_1.7z for comp_arch.7z
+        base,ext = os.path.splitext(self.ARCHIVE_FILE_COMPRESS[1:])
+        return("%s_%d%s"%(base,k,ext))
+
+class file_records_struct:
+    # All backuped files in one store, a record for each path.
+    # Directory prefixes, backup numbers and archive names are interned,
+    # sha is packed in one bytearray and the other columns are arrays.
+    # Only moved files have an org path (path in the archive).
+    # contents is content_index of backuped_files_struct. Its value is the record while
+    # the file stays where it was stored, and (backup number,archive name,is_compressed,path) after.
+    # A deleted record is left as a hole (name None) until compact(), so records keep the order of addition.
+    SHA_SIZE = 32
+
+    def __init__(self):
+        self.clear()
+
+    def clear(self):
+        self.dirs = []  # "folder/sub/" of paths
+        self.dir_id = {}  # "folder/sub" (None for paths without folder):index of dirs
+        self.numbers = []  # backup numbers
+        self.number_id = {}
+        self.archive_names = []
+        self.archive_name_id = {}
+        self.names = []  # name in the folder, None if deleted
+        self.dir_of = array.array("I")
+        self.sha = bytearray()
+        self.other_sha = {}  # record:sha not of SHA_SIZE bytes
+        self.mtime = array.array("d")
+        self.size = array.array("q")  # -1 if not recorded (fileinfo version 1)
+        self.number = array.array("I")
+        self.archive_name = array.array("I")
+        self.compressed = bytearray()
+        self.org_path = {}  # record:path in the archive
+        self.contents = {}  # sha:record or (backup number,archive name,is_compressed,path in archive)
+        self.deleted = 0
+        self.make_index()
+
+    def make_index(self):
+        self.index = [{} for d in self.dirs]  # for each dir, name:record
+        for r,name in enumerate(self.names):
+            if name is not None:
+                self.index[self.dir_of[r]][name] = r
+        self.last = (None,-1)  # last found path and its record
+
+    def get_data(self):
+        # columns for the checkpoint (builtin types only)
+        data = self.__dict__.copy()
+        del data["index"]
+        del data["last"]
+        return(data)
+
+    def set_data(self,data):
+        self.__dict__.update(data)
+        self.make_index()
+
+    def __len__(self):
+        return(len(self.names) - self.deleted)
+
+    def intern(self,values,ids,v):
+        i = ids.get(v)
+        if i is None:
+            i = len(values)
+            values.append(v)
+            ids[v] = i
+        return(i)
+
+    def find(self,path):
+        # record of path, -1 if not found
+        last = self.last
+        if last[0] is path:
+            return(last[1])
+        folder,sep,name = path.rpartition("/")
+        d = self.dir_id.get(folder if sep else None)
+        if d is None:
+            return(-1)
+        r = self.index[d].get(name,-1)
+        if r >= 0:
+            self.last = (path,r)
+        return(r)
+
+    def add(self,path,sha,mtime,size,number,archive_name,is_compressed,org_path):
+        # add path, or overwrite its record if exists
+        k = self.number_id.get(number)
+        if k is None:
+            k = self.intern(self.numbers,self.number_id,number)
+        a = self.archive_name_id.get(archive_name)
+        if a is None:
+            a = self.intern(self.archive_names,self.archive_name_id,archive_name)
+        s = self.SHA_SIZE
+        folder,sep,name = path.rpartition("/")
+        if not sep:
+            folder = None
+        d = self.dir_id.get(folder)
+        r = -1 if d is None else self.index[d].get(name,-1)
+        if r < 0:
+            if d is None:
+                d = len(self.dirs)
+                self.dirs.append(folder + sep if sep else "")
+                self.dir_id[folder] = d
+                self.index.append({})
+            r = len(self.names)
+            self.names.append(name)
+            self.dir_of.append(d)
+            self.sha += sha if len(sha) == s else bytes(s)
+            self.mtime.append(mtime)
+            self.size.append(size)
+            self.number.append(k)
+            self.archive_name.append(a)
+            self.compressed.append(1 if is_compressed else 0)
+            self.index[d][name] = r
+        else:
+            self.release_content(r)
+            if len(sha) == s:
+                self.sha[r*s:(r+1)*s] = sha
+            self.mtime[r] = mtime
+            self.size[r] = size
+            self.number[r] = k
+            self.archive_name[r] = a
+            self.compressed[r] = 1 if is_compressed else 0
+        if len(sha) != s:
+            self.other_sha[r] = sha
+        elif len(self.other_sha) > 0:
+            self.other_sha.pop(r,None)
+        if org_path != False:
+            self.org_path[r] = org_path
+        elif len(self.org_path) > 0:
+            self.org_path.pop(r,None)
+        return(r)
+
+    def remove(self,path):
+        r = self.find(path)
+        if r < 0:
+            raise KeyError(path)
+        self.release_content(r)
+        del self.index[self.dir_of[r]][self.names[r]]
+        self.names[r] = None
+        self.other_sha.pop(r,None)
+        self.org_path.pop(r,None)
+        self.deleted += 1
+        self.last = (None,-1)
+        if self.deleted > 4096 and self.deleted*2 > len(self.names):
+            self.compact()
+
+    def compact(self):
+        # drop deleted records
+        live = [r for r,name in enumerate(self.names) if name is not None]
+        new_record = array.array("l",[-1])*len(self.names)
+        for i,r in enumerate(live):
+            new_record[r] = i
+        s = self.SHA_SIZE
+        self.names = [self.names[r] for r in live]
+        self.dir_of = array.array("I",[self.dir_of[r] for r in live])
+        self.sha = bytearray(b"".join([self.sha[r*s:(r+1)*s] for r in live]))
+        self.other_sha = dict([(new_record[r],v) for r,v in self.other_sha.items()])
+        self.mtime = array.array("d",[self.mtime[r] for r in live])
+        self.size = array.array("q",[self.size[r] for r in live])
+        self.number = array.array("I",[self.number[r] for r in live])
+        self.archive_name = array.array("I",[self.archive_name[r] for r in live])
+        self.compressed = bytearray([self.compressed[r] for r in live])
+        self.org_path = dict([(new_record[r],v) for r,v in self.org_path.items()])
+        for sha,v in self.contents.items():
+            if isinstance(v,int):
+                self.contents[sha] = new_record[v]
+        self.deleted = 0
+        self.make_index()
+
+    def records(self):
+        # (path,record) of all files in the order of addition
+        dirs = self.dirs
+        dir_of = self.dir_of
+        for r,name in enumerate(self.names):
+            if name is not None:
+                path = dirs[dir_of[r]] + name
+                self.last = (path,r)  # the caller often looks it up next
+                yield (path,r)
+
+    def get_path(self,r):
+        return(self.dirs[self.dir_of[r]] + self.names[r])
+
+    def get_content(self,sha):
+        v = self.contents[sha]
+        if isinstance(v,int):
+            return((self.get_number(v),self.get_archive_name(v),self.get_compressed(v),self.get_path(v)))
+        return(v)
+
+    def release_content(self,r):
+        # record r is changed or deleted. Keep the location of its contents if referred by contents.
+        if len(self.contents) > 0:
+            sha = self.get_sha(r)
+            if self.contents.get(sha) == r:
+                self.contents[sha] = self.get_content(sha)
+
+    def get_sha(self,r):
+        if len(self.other_sha) > 0 and r in self.other_sha:
+            return(self.other_sha[r])
+        return(bytes(self.sha[r*self.SHA_SIZE:(r+1)*self.SHA_SIZE]))
+
+    def get_mtime(self,r):
+        return(self.mtime[r])
+
+    def get_size(self,r):
+        return(self.size[r])
+
+    def get_number(self,r):
+        return(self.numbers[self.number[r]])
+
+    def get_archive_name(self,r):
+        return(self.archive_names[self.archive_name[r]])
+
+    def get_compressed(self,r):
+        return(self.compressed[r] == 1)
+
+    def get_org_path(self,r):
+        return(self.org_path.get(r,False))
+
+class file_field_view:
+    # Read only {path:value} view of a column of file_records_struct
+    def __init__(self,records,get_field):
+        self.records = records
+        self.get_field = get_field
+
+    def __getitem__(self,path):
+        r = self.records.find(path)
+        if r < 0:
+            raise KeyError(path)
+        return(self.get_field(r))
+
+    def get(self,path,default=None):
+        r = self.records.find(path)
+        if r < 0:
+            return(default)
+        return(self.get_field(r))
+
+    def __contains__(self,path):
+        return(self.records.find(path) >= 0)
+
+    def __len__(self):
+        return(len(self.records))
+
+    def __iter__(self):
+        for path,r in self.records.records():
+            yield path
+
+    def keys(self):
+        return(self)
+
+    def values(self):
+        for path,r in self.records.records():
+            yield self.get_field(r)
+
+    def items(self):
+        for path,r in self.records.records():
+            yield (path,self.get_field(r))
+
+class content_index_view:
+    # {sha:(backup number,archive name,is_compressed,path in archive)} over contents of file_records_struct
+    def __init__(self,records):
+        self.records = records
+
+    def __getitem__(self,sha):
+        return(self.records.get_content(sha))
+
+    def __setitem__(self,sha,location):
+        self.records.contents[sha] = location
+
+    def get(self,sha,default=None):
+        if sha in self.records.contents:
+            return(self.records.get_content(sha))
+        return(default)
+
+    def __contains__(self,sha):
+        return(sha in self.records.contents)
+
+    def __len__(self):
+        return(len(self.records.contents))
+
+    def __iter__(self):
+        return(iter(self.records.contents))
+
+    def keys(self):
+        return(self)
+
+    def items(self):
+        for sha in self.records.contents:
+            yield (sha,self.records.get_content(sha))
 
 class backuped_files_struct:
     def __init__(self):
-        self.file_sha = {}
-        self.file_mtime = {}
-        self.file_archive_num = {}
-        self.file_org_path = {}
-        self.file_is_compressed = {}
+        self.files = file_records_struct()
+        # {path:value} of each column
+        self.file_sha = file_field_view(self.files,self.files.get_sha)
+        self.file_mtime = file_field_view(self.files,self.files.get_mtime)
+        self.file_archive_num = file_field_view(self.files,self.files.get_number)
+        self.file_org_path = file_field_view(self.files,self.files.get_org_path)  # False if not moved
+        self.file_is_compressed = file_field_view(self.files,self.files.get_compressed)
+        self.file_size = file_field_view(self.files,self.files.get_size)  # -1 if not recorded (fileinfo version 1)
+        self.file_archive_name = file_field_view(self.files,self.files.get_archive_name)  # archive column of fileinfo.txt, "" for default archive
+        self.content_index = content_index_view(self.files)  # sha:(backup number,archive name,is_compressed,path in archive) of stored contents
         self.archive_time = {}
 
     def get_fileinfo_data(self,archive_folder,info_file_name,n):
+        # rows of read_fileinfo
         folder = archive_folder + n
-        if stat.S_ISDIR(os.stat(folder).st_mode):
-            path = archive_folder + n + "/" + info_file_name
-            f = open(path,encoding="utf8")
-            lines = f.read()
-            f.close()
-        else:
+        if not stat.S_ISDIR(os.stat(folder).st_mode):
             print("%s is not a directory"%folder)
             raise FileNotFoundError
-        lines = lines.split('\n')
-        return(lines)
-
-    def reconstruct_incremental(self,archive_folder,info_file_name):
-        self.file_mtime = {}
-        self.file_sha = {}
-        self.file_archive_num = {}
-        self.file_org_path = {}
-        self.file_is_compressed = {}
+        return(read_fileinfo(archive_folder + n + "/" + info_file_name))
+
+    def reconstruct_incremental(self,archive_folder,info_file_name,index_folder=None):
+        self.files.clear()
+        self.replayed_archives = []
+        self.checkpoint_number = None
         num = sorted(list(self.archive_time.keys()))
-        logger.debug("backup to reconstruct%s"%num)
-        for n in num:
-            lines = self.get_fileinfo_data(archive_folder,info_file_name,n)
-            for l in lines[1:]: ## skip 1st line (comment line)
-                c = split_including_commma(l)
-                if len(c)<5:
+        if index_folder:
+            self.load_checkpoint(archive_folder,info_file_name,index_folder,num)
+        logger.debug("backup to reconstruct%s"%num[len(self.replayed_archives):])
+        for n in num[len(self.replayed_archives):]:
+            self.apply_fileinfo(n,self.get_fileinfo_data(archive_folder,info_file_name,n))
+
+    def apply_fileinfo(self,n,rows,changes=None):
+        # rows of read_fileinfo
+        # changes gets {path:kind} of changed paths for timeline_struct.add_backup
+        files = self.files
+        for oldpath,newpath,mtime,flag,sha,size,archive_name in rows:
+            if len(oldpath)>0 and len(newpath)>0 and oldpath!=newpath: # move
+                r = files.find(oldpath)
+                if r < 0:
+                    raise KeyError(oldpath)
+                org_path = files.get_org_path(r)
+                if org_path == False:
+                    org_path = oldpath
+                if newpath == org_path: # come back to the original location
+                    org_path = False
+                files.add(newpath,files.get_sha(r),mtime,size if size>=0 else files.get_size(r),files.get_number(r),files.get_archive_name(r),files.get_compressed(r),org_path)
+                if changes is not None:
+                    changes[newpath] = "V"
+
+            elif len(newpath) > 0 and (flag=="M" or flag=="m"): # only mtime was updated
+                r = files.find(newpath)
+                if r < 0:
+                    logger.warning("mtime of %s updated, but not backuped"%newpath)
                     continue
-                oldpath = get_proper_pathname(c[0])
-                newpath = get_proper_pathname(c[1])
-    
-                if len(oldpath)>0 and len(newpath)>0 and oldpath!=newpath: # move
-                    self.file_mtime[newpath] = str2time(c[2])
-                    self.file_sha[newpath] = self.file_sha[oldpath]
-                    self.file_archive_num[newpath] = self.file_archive_num[oldpath]
-                    self.file_is_compressed[newpath] = self.file_is_compressed[oldpath]
-                    if self.file_org_path[oldpath] == False:
-                        self.file_org_path[newpath] = oldpath
-                    else:
-                        self.file_org_path[newpath] = self.file_org_path[oldpath]
-    
-                    if newpath == self.file_org_path[newpath]: # come back to the original location
-                        self.file_org_path[newpath] = False
-    
-                elif len(newpath) > 0: # new path exist,then add
-                    self.file_mtime[newpath] = str2time(c[2])
-                    self.file_sha[newpath] = bytes.fromhex(c[4])
-                    self.file_archive_num[newpath] = n
-                    self.file_is_compressed[newpath] = (c[3]=="C" or c[3]=="c")
-                    self.file_org_path[newpath] = False
-    
-                if (len(oldpath) > 0 and oldpath!= newpath) : # old path exist,then remove
-                    self.file_mtime.pop(oldpath)
-                    self.file_sha.pop(oldpath)
-                    self.file_archive_num.pop(oldpath)
-                    self.file_is_compressed.pop(oldpath)
-                    self.file_org_path.pop(oldpath)
-    
+                files.mtime[r] = mtime
+                if size>=0:
+                    files.size[r] = size
+                if changes is not None:
+                    changes[newpath] = "M"
+
+            elif len(newpath) > 0: # new path exist,then add
+                sha = bytes.fromhex(sha)
+                if archive_name == backup_config.DEDUP_ARCHIVE_NAME and sha in self.content_index: # contents stored before
+                    src_n,src_archive_name,src_is_compressed,src_path = self.content_index[sha]
+                    files.add(newpath,sha,mtime,size,src_n,src_archive_name,src_is_compressed,src_path if src_path != newpath else False)
+                    if changes is not None:
+                        changes[newpath] = "R"
+                else:
+                    if archive_name == backup_config.DEDUP_ARCHIVE_NAME:
+                        logger.warning("stored contents of %s not found"%newpath)
+                    is_compressed = (flag=="C" or flag=="c")
+                    files.contents[sha] = files.add(newpath,sha,mtime,size,n,archive_name,is_compressed,False)
+                    if changes is not None:
+                        changes[newpath] = "A"
+
+            if (len(oldpath) > 0 and oldpath!= newpath) : # old path exist,then remove
+                files.remove(oldpath)
+                if changes is not None:
+                    changes[oldpath] = "D"
+        self.replayed_archives.append(n)
+
+    def get_fileinfo_signature(self,archive_folder,info_file_name,n):
+        # detect fileinfo.txt rewritten after the checkpoint (same backup number reused etc.)
+        st = os.stat(archive_folder + n + "/" + info_file_name)
+        return((st.st_size,st.st_mtime_ns))
+
+    def load_checkpoint(self,archive_folder,info_file_name,index_folder,num):
+        # Restore the state of the newest usable checkpoint.
+        # Usable means it was made from exactly the first backups of num, and
+        # fileinfo.txt of its last backup is unchanged. Otherwise fall back to full replay.
+        try:
+            files = os.listdir(index_folder)
+        except FileNotFoundError:
+            return(False)
+        candidates = []
+        for f in files:
+            match = re.search("^%s(\\d{10,10})%s$"%(re.escape(backup_config.STATE_INDEX_PREFIX),re.escape(backup_config.STATE_INDEX_EXT)),f)
+            if match and match.group(1) in self.archive_time:
+                candidates.append(match.group(1))
+        for n in sorted(candidates,reverse=True):
+            try:
+                with open(index_folder + backup_config.STATE_INDEX_PREFIX + n + backup_config.STATE_INDEX_EXT,"rb") as f:
+                    state = pickle.load(f)
+                if state["archives"] != num[:len(state["archives"])]:
+                    logger.info("checkpoint %s is stale"%n)
+                    continue
+                if state["signature"] != self.get_fileinfo_signature(archive_folder,info_file_name,n):
+                    logger.info("fileinfo of %s changed after checkpoint"%n)
+                    continue
+                files = state["files"]
+            except (OSError,EOFError,KeyError,TypeError,pickle.UnpicklingError):
+                logger.warning("Can not read checkpoint %s"%n)
+                continue
+            self.files.set_data(files)
+            self.replayed_archives = state["archives"]
+            self.checkpoint_number = n
+            logger.debug("checkpoint %s loaded"%n)
+            return(True)
+        return(False)
+
+    def save_checkpoint(self,archive_folder,info_file_name,index_folder):
+        if len(self.replayed_archives)==0:
+            return
+        n = self.replayed_archives[-1]
+        state = {
+            "archives":self.replayed_archives,
+            "signature":self.get_fileinfo_signature(archive_folder,info_file_name,n),
+            "files":self.files.get_data(),
+            }
+        fname = index_folder + backup_config.STATE_INDEX_PREFIX + n + backup_config.STATE_INDEX_EXT
+        with open(fname + ".tmp","wb") as f:
+            pickle.dump(state,f,protocol=pickle.HIGHEST_PROTOCOL)
+        os.replace(fname + ".tmp",fname) # never leave a half written checkpoint
+        self.checkpoint_number = n
+        checkpoints = sorted([f for f in os.listdir(index_folder) if f.startswith(backup_config.STATE_INDEX_PREFIX) and f.endswith(backup_config.STATE_INDEX_EXT)])
+        for f in checkpoints[:-backup_config.STATE_INDEX_KEEP]:
+            os.remove(index_folder + f)
+
+class timeline_struct:
+    # Versions of each path in INDEX_FOLDER/timeline.sqlite, so the state at a backup and all versions
+    # of a path are found by lookup instead of replaying fileinfo.txt of all backups.
+    # versions has a row for each path changed in each backup, holding its record after the backup.
+    # kind is A=contents stored in the backup, R=ref to contents stored before, V=moved here, M=mtime only, D=deleted
+    def __init__(self):
+        self.db = None
+        self.fname = None
+
+    def open(self,fname):
+        if self.db is not None and self.fname == fname:
+            return(True)
+        try:
+            self.db = sqlite3.connect(fname)
+            with self.db:
+                self.db.execute("CREATE TABLE IF NOT EXISTS backups (number TEXT PRIMARY KEY,size INTEGER,mtime_ns INTEGER)")
+                self.db.execute("CREATE TABLE IF NOT EXISTS versions (path TEXT,number TEXT,kind TEXT,mtime REAL,size INTEGER,sha BLOB,archive_num TEXT,archive_name TEXT,compressed INTEGER,org_path TEXT,PRIMARY KEY(path,number)) WITHOUT ROWID")
+        except sqlite3.Error as e:
+            logger.warning("Can not open timeline index %s %s"%(fname,e))
+            self.db = None
+            return(False)
+        self.fname = fname
+        return(True)
+
+    def close(self):
+        if self.db is not None:
+            self.db.close()
+        self.db = None
+        self.fname = None
+
+    def get_archives(self):
+        # [(backup number,size,mtime_ns of fileinfo.txt)] in the index, oldest first
+        return(self.db.execute("SELECT number,size,mtime_ns FROM backups ORDER BY number").fetchall())
+
+    def add_backup(self,n,signature,files,changes,commit=True):
+        # files is file_records_struct after backup n, changes is {path:kind} of apply_fileinfo
+        rows = []
+        for p,kind in changes.items():
+            r = files.find(p)
+            if r < 0:
+                rows.append((p,n,"D",None,None,None,None,None,None,None))
+                continue
+            org_path = files.get_org_path(r)
+            rows.append((p,n,kind,files.get_mtime(r),files.get_size(r),files.get_sha(r),files.get_number(r),files.get_archive_name(r),int(files.get_compressed(r)),org_path if org_path != False else None))
+        self.db.executemany("INSERT OR REPLACE INTO versions VALUES (?,?,?,?,?,?,?,?,?,?)",rows)
+        self.db.execute("INSERT OR REPLACE INTO backups VALUES (?,?,?)",(n,signature[0],signature[1]))
+        if commit:
+            self.db.commit()
+
+    def sync(self,archive_folder,info_file_name,num):
+        # Add backups of num not in the index yet. The index is made again if it has backups
+        # not in num, or fileinfo.txt changed after it was indexed (consolidate etc.)
+        state = backuped_files_struct()
+        indexed = self.get_archives()
+        k = 0
+        while k < len(indexed) and k < len(num) and indexed[k][0] == num[k]:
+            if tuple(indexed[k][1:]) != state.get_fileinfo_signature(archive_folder,info_file_name,num[k]):
+                break
+            k += 1
+        if k < len(indexed):
+            logger.info("timeline index is stale")
+            with self.db:
+                self.db.execute("DELETE FROM versions")
+                self.db.execute("DELETE FROM backups")
+            k = 0
+        if k == len(num):
+            return
+        print("Make timeline index of %d backups"%(len(num)-k))
+        state.replayed_archives = []
+        for i,n in enumerate(num):
+            changes = {} if i >= k else None
+            state.apply_fileinfo(n,state.get_fileinfo_data(archive_folder,info_file_name,n),changes)
+            if changes is not None:
+                self.add_backup(n,state.get_fileinfo_signature(archive_folder,info_file_name,n),state.files,changes,False)
+        self.db.commit() # at once, much faster than for each backup
+
+    def load_state(self,backuped_files,n,paths=None):
+        # backuped_files gets files existing after backup n (only paths if given)
+        columns = "path,number,kind,mtime,size,sha,archive_num,archive_name,compressed,org_path"
+        if paths:
+            rows = [self.db.execute("SELECT %s FROM versions WHERE path=? AND number<=? ORDER BY number DESC LIMIT 1"%columns,(p,n)).fetchone() for p in dict.fromkeys(paths)]
+        else:
+            # sqlite takes the other columns from the row of MAX(number)
+            rows = self.db.execute("SELECT %s FROM versions WHERE number<=? GROUP BY path"%columns.replace("number","MAX(number)",1),(n,))
+        files = backuped_files.files
+        files.clear()
+        for row in rows:
+            if row is None or row[2] == "D":
+                continue
+            p,number,kind,mtime,size,sha,archive_num,archive_name,compressed,org_path = row
+            files.add(p,sha,mtime,size,archive_num,archive_name,compressed==1,org_path if org_path is not None else False)
+
+    def get_versions(self,targets,prefixes):
+        # (path,backup number,sha,backup number of contents,archive name,is_compressed,path in archive)
+        # of contents added to targets (files or all files under folders) and paths starting with prefixes
+        columns = "path,number,sha,archive_num,archive_name,compressed,org_path"
+        queries = []
+        for p in targets:
+            queries.append(("path=?",(p,)))
+            queries.append(("path>=? AND path<?",(p + "/",p + "0"))) # "0" is next to "/"
+        for p in prefixes:
+            if p == "":
+                queries.append(("1",()))
+            else:
+                queries.append(("path>=? AND path<?",(p,p[:-1] + chr(ord(p[-1])+1))))
+        found = set()
+        for where,args in queries:
+            for p,n,sha,src_n,archive_name,compressed,org_path in self.db.execute("SELECT %s FROM versions WHERE %s AND kind IN ('A','R') ORDER BY path,number"%(columns,where),args):
+                if (p,n) in found:
+                    continue
+                found.add((p,n))
+                yield((p,n,sha,src_n,archive_name,compressed==1,org_path if org_path is not None else p))
+
+timeline = timeline_struct()
+
 def feedbackbeep(is_success):
     if not backup_config.DO_BEEP:
         return
@@ -222,11 +765,89 @@ def feedbackbeep(is_success):
                     pass
         
 
+time2str_cache = {}  # t//60:"YYYY/MM/DD-HH:MM:"
+str2time_cache = {}  # "YYYY/MM/DD-HH":time of HH:00:00, False if utc offset changes
+
 def time2str(t):
-    return(time.strftime("%Y/%m/%d-%H:%M:%S",time.localtime(t)))
+    # localtime is called once a minute of t
+    m = int(t//60)
+    prefix = time2str_cache.get(m)
+    if prefix is None:
+        lt = time.localtime(m*60)
+        if lt.tm_sec != 0: # utc offset of seconds (before 1900s)
+            return(time.strftime("%Y/%m/%d-%H:%M:%S",time.localtime(t)))
+        if len(time2str_cache) > 100000:
+            time2str_cache.clear()
+        prefix = time.strftime("%Y/%m/%d-%H:%M:",lt)
+        time2str_cache[m] = prefix
+    return("%s%02d"%(prefix,int(t//1) - m*60))
 
 def str2time(s):
-    return(time.mktime(time.strptime(s,"%Y/%m/%d-%H:%M:%S")))
+    # mktime is called once an hour of s, except hours near the change of utc offset (daylight saving time)
+    if len(s) != 19 or s[13] != ":" or s[16] != ":" or not (s[14:16]+s[17:19]).isdigit():
+        return(time.mktime(time.strptime(s,"%Y/%m/%d-%H:%M:%S")))
+    base = str2time_cache.get(s[:13])
+    if base is None:
+        base = time.mktime(time.strptime(s[:13],"%Y/%m/%d-%H"))
+        if len(set([time.localtime(base + d).tm_gmtoff for d in (-3600,0,3600)])) > 1:
+            base = False
+        str2time_cache[s[:13]] = base
+    if base is False:
+        return(time.mktime(time.strptime(s,"%Y/%m/%d-%H:%M:%S")))
+    return(base + int(s[14:16])*60 + int(s[17:19]))
+
+FILEINFO_PATHS = re.compile(r'(?:"(.*?)"|([^",]*)),(?:"(.*?)"|([^",]*)),(.*)')  # quoted paths may include ','
+
+def parse_fileinfo_line(l):
+    # (previous path,new path,mtime,flag,sha,size,archive name) of a line of fileinfo.txt, None if not a file.
+    # Paths are proper pathnames ("" if blank). sha is hex.
+    # mtime is None for a deleted file, size is -1 and archive name is "" if not recorded.
+    m = FILEINFO_PATHS.match(l)
+    if m is None:
+        return(None)
+    quoted_old,oldpath,quoted_new,newpath,rest = m.groups()
+    if quoted_old is not None:
+        oldpath = quoted_old
+    if quoted_new is not None:
+        newpath = quoted_new
+    if "\\" in oldpath or "\\" in newpath:
+        oldpath = oldpath.replace("\\","/")
+        newpath = newpath.replace("\\","/")
+    if oldpath.endswith("/") or newpath.endswith("/"):
+        oldpath = oldpath.rstrip("/")
+        newpath = newpath.rstrip("/")
+    c = rest.split(",")
+    if len(c)<3:
+        return(None)
+    if len(c)>4 and c[4]!="": # version 2
+        mtime = int(c[4])/1e9
+    elif newpath != "":
+        mtime = str2time(c[0])
+    else:
+        mtime = None
+    size = int(c[3]) if len(c)>3 and c[3]!="" else -1
+    return((oldpath,newpath,mtime,c[1],c[2],size,c[5] if len(c)>5 else ""))
+
+def parse_fileinfo(lines):
+    # Rows of parse_fileinfo_line from lines of fileinfo.txt (without the header line)
+    for l in lines:
+        row = parse_fileinfo_line(l)
+        if row is not None:
+            yield row
+
+def read_fileinfo(fname):
+    # Rows of parse_fileinfo_line, reading fileinfo.txt line by line
+    with open(fname,encoding="utf8") as f:
+        f.readline() # header (comment line)
+        for row in parse_fileinfo(f):
+            yield row
+
+def format_fileinfo_line(oldpath,newpath,mtime,flag,sha,stat=None,archive_name=""):
+    # A line of fileinfo.txt. Blank newpath deletes oldpath. stat is (size,mtime_ns) of version 2.
+    # mtime_ns is read back as float seconds (about 240ns precision), so it is approximate in fileinfo.txt written by consolidate.
+    if newpath == "":
+        return('"%s",,-1,%s,00\n'%(oldpath,flag))
+    return('%s,"%s",%s,%s,%s,%s%s\n'%('"%s"'%oldpath if oldpath != "" else "",newpath,time2str(mtime),flag,bytes.hex(sha).upper(),"%d,%d"%stat if stat else ",","," + archive_name if archive_name != "" else ""))
 
 def delete_temporary_file(file):
     os.remove(file)
@@ -241,7 +862,10 @@ def create_path(full_path):
     for s in each_path[:-1]:
         path = path + s +path_sym
         if not os.path.isdir(path):
-            os.mkdir(path)
+            try:
+                os.mkdir(path)
+            except FileExistsError: # made by another thread
+                pass
 
 def strip_double_quote(s):
     if len(s)>2 and s[0]=='"':
@@ -269,24 +893,6 @@ def strip_path(s):
 def backslash_to_slash(s):
     return(re.sub("\\\\","/",s))
 
-def split_including_commma(l):
-    #concat path name if path name include ',' 20170929 added
-    c_org = l.split(",")
-    if len(c_org)<5:
-        return([])
-    c = []
-    for filenames in range(2):
-        c.append(c_org.pop(0))
-        while True:
-            if len(c[-1])==0:  # No file name 
-                break
-            if c[-1][-1] == '"':
-                break
-            c[-1] += ','
-            c[-1] += c_org.pop(0)
-    c += c_org
-    return(c)
-
 def get_proper_pathname(s):
     # Internally 
     #    use / (not \) 
@@ -299,22 +905,93 @@ def get_proper_pathname(s):
         p = p[:-1]
     return(p)
     
+def get_backup_numbers(archive_folder):
+    return(sorted([f for f in os.listdir(archive_folder) if re.search("^(\d{10,10})$",f)]))
+
+def write_archive_time(folder,t=None):
+    # Record the time of the backup (default now) in the backup folder. Returns the time.
+    if t is None:
+        t = time.time()
+    with open(folder + "/" + backup_config.ARCHIVE_TIME_FILE_NAME,"wt",encoding="utf8") as f:
+        f.write("%s,%d\n"%(time2str(t),round(t*1e9)))
+    return(t)
+
+def read_archive_time(folder):
+    # time by write_archive_time, or mtime of the folder for backups made before it
+    # (the mtime changes when backups are copied to another disk)
+    try:
+        with open(folder + "/" + backup_config.ARCHIVE_TIME_FILE_NAME,encoding="utf8") as f:
+            return(int(f.read().split(",")[1])/1e9)
+    except (OSError,IndexError,ValueError):
+        return(os.stat(folder).st_mtime)
+
 def create_backup_file_obj(archive_folder,recovery_time):
     backup_exec = {}
-    folders = os.listdir(archive_folder)
-    for f in folders:
-        match = re.search("^(\d{10,10})$",f)
-        if match:
-            logger.debug(f)
-            t = os.stat(archive_folder+f).st_mtime 
-            if recovery_time<0 or t <= recovery_time:
-                backup_exec[f] = t
+    for f in get_backup_numbers(archive_folder):
+        logger.debug(f)
+        t = read_archive_time(archive_folder+f)
+        if recovery_time<0 or t <= recovery_time:
+            backup_exec[f] = t
     created_data = backuped_files_struct()
     created_data.archive_time = backup_exec
     return(created_data)
 
-def find_files(folder,reject_pattern_list):
-    mtime = {}
+def open_timeline():
+    # timeline index covering all backups, None if not used or not available
+    if not backup_config.USE_TIMELINE:
+        return(None)
+    if not timeline.open(backup_config.INDEX_FOLDER + backup_config.TIMELINE_FILE_NAME):
+        return(None)
+    try:
+        timeline.sync(backup_config.ARCHIVE_FOLDER,backup_config.ARCHIVE_FILE_INFO_NAME,get_backup_numbers(backup_config.ARCHIVE_FOLDER))
+    except sqlite3.Error as e:
+        logger.warning("Can not update timeline index %s"%e)
+        return(None)
+    return(timeline)
+
+def add_backup_to_timeline(n,changes):
+    # After backup n was applied to backuped_files. If the index does not have all previous backups,
+    # it is made from fileinfo.txt.
+    if not backup_config.USE_TIMELINE:
+        return
+    if not timeline.open(backup_config.INDEX_FOLDER + backup_config.TIMELINE_FILE_NAME):
+        return
+    try:
+        if [a[0] for a in timeline.get_archives()] == backuped_files.replayed_archives[:-1]:
+            timeline.add_backup(n,backuped_files.get_fileinfo_signature(backup_config.ARCHIVE_FOLDER,backup_config.ARCHIVE_FILE_INFO_NAME,n),backuped_files.files,changes)
+        else:
+            timeline.sync(backup_config.ARCHIVE_FOLDER,backup_config.ARCHIVE_FILE_INFO_NAME,backuped_files.replayed_archives)
+    except sqlite3.Error as e:
+        logger.warning("Can not update timeline index %s"%e)
+
+def compile_reject_patterns(reject_pattern_list):
+    # Returns a function which tells whether a path matches any of the patterns, or None without pattern.
+    # Patterns are combined into one regular expression when it does not change their meaning.
+    if len(reject_pattern_list)==0:
+        return(None)
+    compiled = [re.compile(ptn) for ptn in reject_pattern_list]
+    if len(compiled)==1:
+        return(compiled[0].search)
+    combinable = True
+    for ptn,c in zip(reject_pattern_list,compiled):
+        if (c.groups>0 and re.search(r"\\\d|\(\?P=",ptn)) or c.flags & ~re.UNICODE: # back reference or global inline flag
+            combinable = False
+    if combinable:
+        try:
+            return(re.compile("|".join(["(?:%s)"%ptn for ptn in reject_pattern_list])).search)
+        except re.error:
+            pass
+    def search_any(f):
+        for c in compiled:
+            if c.search(f):
+                return(True)
+        return(False)
+    return(search_any)
+
+def read_folder(folder,reject):
+    # Read one directory. Returns entries in os.scandir order,
+    # (path,None) for a folder to enter and (path,st_mtime,st_size,st_mtime_ns) for a file.
+    entries = []
     try:
         if len(folder)>0:
             files = os.scandir(folder,)
@@ -322,40 +999,73 @@ def find_files(folder,reject_pattern_list):
             files = os.scandir(".")
     except PermissionError:
         logger.warning("Permission error for listdir %s"%folder)
-        return(mtime)
-#    for f1 in files:
-    for entry in files:
-        f1 = entry.name
-        if len(folder)>0 and not (folder[-1]=='/' or folder[-1]=='\\'): 
-            f = folder+'/'+f1
-        else:
-            f = folder+f1
-        flag = False
-        for ptn in reject_pattern_list:
-            mt =  re.search(ptn,f)
-            if mt:
-                flag = True
-                break
-        if flag:
-            continue
-#        if os.path.isdir(f) and ((f in BACKUP_STOP_FOLDER)or(f+'/' in BACKUP_STOP_FOLDER)):
-        if entry.is_dir(follow_symlinks=False) and ((f in backup_config.BACKUP_STOP_FOLDER)or(f+'/' in backup_config.BACKUP_STOP_FOLDER)):
-            continue
-#        if os.path.isdir(f) :
-        if entry.is_dir(follow_symlinks=False) :
-            _mtime = find_files(f,reject_pattern_list)
-            for _m in _mtime.keys():
-                mtime[_m] = _mtime[_m]
-        else:
-            if os.path.islink(f):
+        return(entries)
+    with files:
+        for entry in files:
+            f1 = entry.name
+            if len(folder)>0 and not (folder[-1]=='/' or folder[-1]=='\\'): 
+                f = folder+'/'+f1
+            else:
+                f = folder+f1
+            if reject is not None and reject(f):
                 continue
-            try:
-                mtime[f] = entry.stat(follow_symlinks=False).st_mtime
-            except PermissionError:
-                logger.warning("Permission error %s"%f)
+            if entry.is_dir(follow_symlinks=False) :
+                if f in backup_config.BACKUP_STOP_FOLDER: # BACKUP_STOP_FOLDER is a set of paths without last /
+                    continue
+                entries.append((f,None))
+            else:
+                if entry.is_symlink():
+                    continue
+                try:
+                    st = entry.stat(follow_symlinks=False)
+                    entries.append((f,st.st_mtime,st.st_size,st.st_mtime_ns))
+                except PermissionError:
+                    logger.warning("Permission error %s"%f)
+    return(entries)
+
+def find_files(folder,reject_pattern_list,file_stat=None,mtime=None):
+    # Returns {path:mtime} of files under folder, in depth first order of os.scandir.
+    # Results are added to mtime if given. If file_stat is given, (size,mtime_ns) of each file is stored to it.
+    # reject_pattern_list is a list of patterns or a function made by compile_reject_patterns
+    # With backup_config.SCAN_WORKERS > 1, directories are read by a thread pool ahead of the depth first walk.
+    if isinstance(reject_pattern_list,list):
+        reject_pattern_list = compile_reject_patterns(reject_pattern_list)
+    if mtime is None:
+        mtime = {}
+    if backup_config.SCAN_WORKERS > 1:
+        executor = concurrent.futures.ThreadPoolExecutor(max_workers=backup_config.SCAN_WORKERS)
+        futures = {}
+        def read_and_submit(folder):
+            entries = read_folder(folder,reject_pattern_list)
+            for e in entries:
+                if e[1] is None:
+                    futures[e[0]] = executor.submit(read_and_submit,e[0])
+            return(entries)
+        def get_entries(folder):
+            return(futures.pop(folder).result())
+        futures[folder] = executor.submit(read_and_submit,folder)
+    else:
+        executor = None
+        def get_entries(folder):
+            return(read_folder(folder,reject_pattern_list))
+    try:
+        stack = [iter(get_entries(folder))]
+        while len(stack)>0:
+            for e in stack[-1]:
+                if e[1] is None:
+                    stack.append(iter(get_entries(e[0])))
+                    break
+                mtime[e[0]] = e[1]
+                if file_stat is not None:
+                    file_stat[e[0]] = (e[2],e[3])
+            else:
+                stack.pop()
+    finally:
+        if executor is not None:
+            executor.shutdown(wait=True)
     return(mtime)
 
-def search_target_file_and_get_mtime(_backup_top):
+def search_target_file_and_get_mtime(_backup_top,file_stat=None):
     mtimes = {}
     print("Searching target")
     for backup_folder in _backup_top.keys():
@@ -365,20 +1075,331 @@ def search_target_file_and_get_mtime(_backup_top):
         else:
             is_folder = True
         if is_folder:
-            mtime = find_files(backup_folder,_backup_top[backup_folder])
-            print(" %d files in %s"%(len(mtime),backup_folder))
-            for m in mtime:  ##### better method ?
-                mtimes[m] = mtime[m]
+            n = len(mtimes)
+            find_files(backup_folder,compile_reject_patterns(_backup_top[backup_folder]),file_stat,mtimes)
+            print(" %d files in %s"%(len(mtimes)-n,backup_folder))
         else:
             try:
-                mtimes[backup_folder] = os.stat(backup_folder).st_mtime
+                st = os.stat(backup_folder)
+                mtimes[backup_folder] = st.st_mtime
+                if file_stat is not None:
+                    file_stat[backup_folder] = (st.st_size,st.st_mtime_ns)
             except FileNotFoundError:
                 logger.warning("FileNotFoundError %s"%backup_folder)
             except PermissionError:
                 logger.warning("Permission error %s"%backup_folder)
     return(mtimes)
 
+def get_backup_root(path):
+    # Returns the configured folder (or file) which path belongs to, None if it is out of backup.
+    p = path
+    while True:
+        if p in backup_config.BACKUP_STOP_FOLDER:
+            if p in backup_config.dst_top:
+                return(p)
+            return(None)  # folder with .+ pattern
+        i = p.rfind("/")
+        if i <= 0:
+            return(None)
+        p = p[:i]
+
+reject_matchers = {}  # backup root:compiled exclude patterns
+def get_reject_matcher(root):
+    if root not in reject_matchers:
+        reject_matchers[root] = compile_reject_patterns(backup_config.dst_top[root])
+    return(reject_matchers[root])
+
+def is_path_to_backup(path,root=None):
+    # Same decision as find_files walking from the configured folder down to path.
+    if root is None:
+        root = get_backup_root(path)
+    if root is None:
+        return(False)
+    reject = get_reject_matcher(root)
+    if reject is None or path == root:
+        return(True)
+    p = path
+    while len(p) > len(root):
+        if reject(p):
+            return(False)
+        p = p[:p.rfind("/")]
+    return(True)
+
+class change_journal_struct:
+    # Files in INDEX_FOLDER
+    #  watcher.pid         "pid,watcher id" of the running watcher
+    #  journal.txt         lines written by the watcher
+    #                        S,watcher id   watcher started and all folders are watched
+    #                        O              event queue overflowed, some events are lost
+    #                        C|M|D|F|T,path create,modify,delete,move from,move to (folder path ends with /)
+    #  journal_state.txt   "watcher id,offset,backup number" the index of the backup number
+    #                      includes all changes before offset of journal.txt
+    def __init__(self,index_folder):
+        self.pid_file = index_folder + backup_config.JOURNAL_PID_FILE_NAME
+        self.journal_file = index_folder + backup_config.JOURNAL_FILE_NAME
+        self.state_file = index_folder + backup_config.JOURNAL_STATE_FILE_NAME
+
+    def get_watcher_id(self):
+        # id of the running watcher, None if no watcher is running
+        if not sys.platform.startswith("linux"):
+            return(None) # no watch mode, os.kill(pid,0) terminates the process on windows
+        try:
+            with open(self.pid_file,encoding="utf8") as f:
+                pid,watcher_id = f.read().strip().split(",")
+            os.kill(int(pid),0)
+        except (OSError,ValueError):
+            return(None)
+        return(watcher_id)
+
+    def mark(self):
+        # (watcher id,offset) at the beginning of a scan
+        watcher_id = self.get_watcher_id()
+        if watcher_id is None:
+            return(None)
+        try:
+            return((watcher_id,os.stat(self.journal_file).st_size))
+        except FileNotFoundError:
+            return(None)
+
+    def save_state(self,mark,backup_number):
+        if mark is None:
+            return
+        with open(self.state_file + ".tmp","wt",encoding="utf8") as f:
+            f.write("%s,%d,%s\n"%(mark[0],mark[1],backup_number))
+        os.replace(self.state_file + ".tmp",self.state_file)
+
+    def read_changes(self,mark,backup_number):
+        # Returns [paths changed after the last backup] or None if the journal does not cover it.
+        if mark is None:
+            return(None)
+        try:
+            with open(self.state_file,encoding="utf8") as f:
+                watcher_id,offset,state_number = f.read().strip().split(",")
+            offset = int(offset)
+        except (OSError,ValueError):
+            return(None)
+        if watcher_id != mark[0] or state_number != backup_number or offset > mark[1]:
+            return(None)
+        with open(self.journal_file,"rb") as f:
+            f.seek(offset)
+            lines = f.read(mark[1]-offset).decode("utf8",errors="surrogateescape").split("\n")
+        if self.get_watcher_id() != mark[0]: # journal may be restarted while reading
+            return(None)
+        paths = []
+        for l in lines:
+            if l == "":
+                continue
+            if l[0] in "SO":  # restarted or lost events
+                logger.warning("journal is not complete (%s)"%l)
+                return(None)
+            paths.append(l[2:])
+        return(paths)
+
+change_journal = None
+
+def search_changed_file_and_get_mtime(changed_paths,p_mtime,p_size,file_stat):
+    # Make the same result as search_target_file_and_get_mtime from the last backup and the journal.
+    changed_folders = set()
+    changed_files = set()
+    for p in changed_paths:
+        if p[-1] == "/":
+            changed_folders.add(p[:-1])
+        else:
+            changed_files.add(p)
+    mtimes = {}
+    for path in p_mtime.keys():
+        if path in changed_files:
+            continue
+        if len(changed_folders) > 0 and is_in_changed_folder(path,changed_folders):
+            continue
+        mtimes[path] = p_mtime[path]
+        file_stat[path] = (p_size[path],int(round(p_mtime[path]*1e9))) # mtime_ns of unchanged files is not written
+    print("Checking %d changed files and %d changed folders"%(len(changed_files),len(changed_folders)))
+    for path in changed_files:
+        if not is_path_to_backup(path):
+            continue
+        try:
+            st = os.lstat(path)
+        except FileNotFoundError:
+            continue
+        except PermissionError:
+            logger.warning("Permission error %s"%path)
+            continue
+        if stat.S_ISREG(st.st_mode):
+            mtimes[path] = st.st_mtime
+            file_stat[path] = (st.st_size,st.st_mtime_ns)
+    for folder in changed_folders:
+        root = get_backup_root(folder)
+        if root is None or not os.path.isdir(folder) or os.path.islink(folder) or not is_path_to_backup(folder,root):
+            continue
+        find_files(folder,get_reject_matcher(root),file_stat,mtimes)
+    return(mtimes)
+
+def is_in_changed_folder(path,changed_folders):
+    # Files in other backup folders (BACKUP_STOP_FOLDER) are not scanned with the parent folder.
+    p = path
+    i = p.rfind("/")
+    while i > 0:
+        p = p[:i]
+        if p in changed_folders:
+            return(True)
+        if p in backup_config.BACKUP_STOP_FOLDER:
+            return(False)
+        i = p.rfind("/")
+    return(False)
+
+# inotify(7)
+IN_MODIFY = 0x00000002
+IN_ATTRIB = 0x00000004
+IN_CLOSE_WRITE = 0x00000008
+IN_MOVED_FROM = 0x00000040
+IN_MOVED_TO = 0x00000080
+IN_CREATE = 0x00000100
+IN_DELETE = 0x00000200
+IN_DELETE_SELF = 0x00000400
+IN_MOVE_SELF = 0x00000800
+IN_Q_OVERFLOW = 0x00004000
+IN_IGNORED = 0x00008000
+IN_ONLYDIR = 0x01000000
+IN_DONT_FOLLOW = 0x02000000
+IN_ISDIR = 0x40000000
+
+def watch():
+    # Record changes under the backup folders to the journal until Ctrl-C.
+    import ctypes
+    import ctypes.util
+    if not sys.platform.startswith("linux"):
+        print("watch mode needs inotify (linux)")
+        return
+    if change_journal.get_watcher_id() is not None:
+        print("watcher is already running (%s)"%change_journal.pid_file)
+        return
+    libc = ctypes.CDLL(ctypes.util.find_library("c") or "libc.so.6",use_errno=True)
+    fd = libc.inotify_init1(os.O_CLOEXEC)
+    if fd < 0:
+        raise OSError(ctypes.get_errno(),"inotify_init1")
+    mask = IN_MODIFY|IN_ATTRIB|IN_CLOSE_WRITE|IN_MOVED_FROM|IN_MOVED_TO|IN_CREATE|IN_DELETE|IN_DELETE_SELF|IN_MOVE_SELF|IN_ONLYDIR|IN_DONT_FOLLOW
+    watch_folder = {}  # watch descriptor:(folder,root)
+    journal = open(change_journal.journal_file,"wt",encoding="utf8",errors="surrogateescape")
+
+    def add_watch(folder,root):
+        wd = libc.inotify_add_watch(fd,os.fsencode(folder if len(folder)>0 else "."),mask)
+        if wd < 0:
+            err = ctypes.get_errno()
+            if err in (errno.ENOENT,errno.EACCES,errno.ENOTDIR):
+                logger.warning("Can not watch %s"%folder)
+                return(False)
+            raise OSError(err,"inotify_add_watch %s"%folder)  # ENOSPC: increase fs.inotify.max_user_watches
+        if wd not in watch_folder or watch_folder[wd][1] is None:
+            watch_folder[wd] = (folder,root)
+        return(True)
+
+    def add_watch_tree(folder,root):
+        # watch folder and sub folders, in the same way find_files walks
+        if not add_watch(folder,root):
+            return
+        reject = get_reject_matcher(root)
+        stack = [folder]
+        while len(stack) > 0:
+            for e in read_folder(stack.pop(),reject):
+                if e[1] is None and add_watch(e[0],root):
+                    stack.append(e[0])
+
+    prev_dir = os.getcwd()
+    os.chdir(backup_config.src_top)
+    print("Entered %s"%backup_config.src_top)
+    watch_file = {}  # folder:[files] for backup roots which are files
+    for root in backup_config.dst_top.keys():
+        if os.path.isdir(root):
+            add_watch_tree(root,root)
+        else:
+            folder = root[:root.rfind("/")] if "/" in root else ""
+            watch_file.setdefault(folder,[]).append(root)
+            add_watch(folder,None)
+    with open(change_journal.pid_file + ".tmp","wt",encoding="utf8") as f:
+        watcher_id = "%x%x"%(os.getpid(),time.time_ns() if hasattr(time,"time_ns") else int(time.time()*1e9))
+        f.write("%d,%s\n"%(os.getpid(),watcher_id))
+    os.replace(change_journal.pid_file + ".tmp",change_journal.pid_file)
+    journal.write("S,%s\n"%watcher_id)
+    journal.flush()
+    print("watching %d folders. Ctrl-C to stop."%len(watch_folder))
+    def stop_by_signal(signum,frame):
+        raise KeyboardInterrupt
+    signal.signal(signal.SIGTERM,stop_by_signal)
+    header = struct.Struct("iIII")
+    try:
+        while True:
+            buf = os.read(fd,65536)
+            i = 0
+            while i < len(buf):
+                wd,ev,cookie,name_len = header.unpack_from(buf,i)
+                name = os.fsdecode(buf[i+header.size:i+header.size+name_len].rstrip(b"\0"))
+                i += header.size + name_len
+                if ev & IN_Q_OVERFLOW:
+                    journal.write("O\n")
+                    continue
+                if wd not in watch_folder:
+                    continue
+                folder,root = watch_folder[wd]
+                if ev & IN_IGNORED:
+                    watch_folder.pop(wd)
+                    continue
+                if len(name) == 0:
+                    if ev & (IN_DELETE_SELF|IN_MOVE_SELF) and (root is None or folder == root):
+                        journal.write("O\n") # parent of the backup folder is not watched
+                    continue
+                path = folder+'/'+name if len(folder)>0 and folder[-1]!='/' else folder+name
+                if path in watch_file.get(folder,[]):  # file to backup
+                    pass
+                elif root is None or not is_path_to_backup(path,root):
+                    continue
+                if ev & IN_ISDIR:
+                    if path in backup_config.BACKUP_STOP_FOLDER:
+                        if path not in backup_config.dst_top:
+                            continue
+                        root = path # another backup folder
+                    if ev & IN_MOVED_FROM:
+                        # watches keep the folder after a rename, remove them with the old paths.
+                        # IN_MOVED_TO watches the folder again if it is moved inside the backup folders.
+                        for w in [w for w,(f,r) in watch_folder.items() if f == path or f.startswith(path + "/")]:
+                            watch_folder.pop(w)
+                            libc.inotify_rm_watch(fd,w)
+                    if ev & (IN_CREATE|IN_MOVED_TO):
+                        add_watch_tree(path,root)
+                    path += "/"
+                if "\n" in path:  # keep one path per line, check the folder instead
+                    path = folder + "/"
+                if ev & IN_CREATE:
+                    kind = "C"
+                elif ev & IN_DELETE:
+                    kind = "D"
+                elif ev & IN_MOVED_FROM:
+                    kind = "F"
+                elif ev & IN_MOVED_TO:
+                    kind = "T"
+                else:
+                    kind = "M"
+                journal.write("%s,%s\n"%(kind,path))
+            journal.flush()
+            if journal.tell() > backup_config.JOURNAL_MAX_SIZE:
+                # start a new journal with a new id, next backup scans all folders.
+                watcher_id += "+"
+                with open(change_journal.pid_file,"wt",encoding="utf8") as f:
+                    f.write("%d,%s\n"%(os.getpid(),watcher_id))
+                journal.close()
+                journal = open(change_journal.journal_file,"wt",encoding="utf8",errors="surrogateescape")
+                journal.write("S,%s\n"%watcher_id)
+                journal.flush()
+    except KeyboardInterrupt:
+        print("stop watching")
+    finally:
+        journal.close()
+        os.close(fd)
+        os.remove(change_journal.pid_file)
+        os.chdir(prev_dir)
+
 calc_hash_count = 0
+calc_hash_lock = threading.Lock()
 def calc_hash(path):
     global calc_hash_count
 ##    try:
@@ -387,47 +1408,304 @@ def calc_hash(path):
     with open(path, 'rb') as f:
         for chunk in iter(lambda: f.read(2048 * m.block_size), b''):
             m.update(chunk)
-            calc_hash_count += 1
-            if calc_hash_count >= dispdot:
-                calc_hash_count -= dispdot
-                sys.stdout.write(".")
-                sys.stdout.flush()
+            with calc_hash_lock:
+                calc_hash_count += 1
+                if calc_hash_count >= dispdot:
+                    calc_hash_count -= dispdot
+                    sys.stdout.write(".")
+                    sys.stdout.flush()
     return(m.digest())
 
-def find_difference(p_mtime,p_sha,new_mtime):
-    add_sha = {}
+def calc_hash_or_none(path):
+    try:
+        return(calc_hash(path))
+    except PermissionError:
+        logger.warning("Permission denied for %s"%path)
+        return(None)
+
+class hash_cache_struct:
+    def __init__(self):
+        self.run_sha = {}  # path:sha (None if not permitted) calculated in this run
+        self.file_sha = collections.OrderedDict()  # (st_dev,st_ino,st_size,st_mtime_ns,st_ctime_ns):sha, oldest first
+        self.enabled = False
+        self.max_entries = 0
+        self.lock = threading.Lock()
+
+    def load(self,fname,max_entries):
+        self.enabled = True
+        self.max_entries = max_entries
+        try:
+            with open(fname,"rb") as f:
+                self.file_sha = pickle.load(f)
+        except FileNotFoundError:
+            pass
+        except (OSError,EOFError,pickle.UnpicklingError):
+            logger.warning("Can not read hash cache %s"%fname)
+        if len(self.file_sha) > 0 and len(next(iter(self.file_sha))) != 5: # made without st_ctime_ns
+            self.file_sha = collections.OrderedDict()
+        logger.debug("%d entries in hash cache"%len(self.file_sha))
+
+    def save(self,fname):
+        if not self.enabled:
+            return
+        with open(fname + ".tmp","wb") as f:
+            pickle.dump(self.file_sha,f,protocol=pickle.HIGHEST_PROTOCOL)
+        os.replace(fname + ".tmp",fname)
+
+    def get_key(self,path):
+        try:
+            st = os.stat(path)
+        except OSError:
+            return(None)
+        if st.st_ino == 0: # file system without inode number
+            return(None)
+        # mtime can be set by cp -p, tar or rsync -t, so a new file on the inode of a deleted file
+        # may have the same size and mtime. ctime can not be set, it differs.
+        return((st.st_dev,st.st_ino,st.st_size,st.st_mtime_ns,st.st_ctime_ns))
+
+    def calc_hash(self,path):
+        if not self.enabled:
+            return(calc_hash_or_none(path))
+        key = self.get_key(path)
+        with self.lock:
+            sha = self.file_sha.get(key)
+            if sha is not None:
+                self.file_sha.move_to_end(key)
+                return(sha)
+        sha = calc_hash_or_none(path)
+        self.store(path,key,sha)
+        return(sha)
+
+    def store(self,path,key,sha):
+        # key is get_key(path) before reading the file
+        if not self.enabled:
+            return
+        if key is not None and sha is not None and key == self.get_key(path): # not modified while reading
+            with self.lock:
+                self.file_sha[key] = sha
+                while len(self.file_sha) > self.max_entries:
+                    self.file_sha.popitem(last=False)
+
+    def get_known(self,path):
+        # sha of path if it is got without reading the file, else None
+        if path in self.run_sha:
+            return(self.run_sha[path])
+        if not self.enabled:
+            return(None)
+        with self.lock:
+            return(self.file_sha.get(self.get_key(path)))
+
+    def is_known(self,path):
+        # True if sha of path is got without reading the file
+        if path in self.run_sha:
+            return(True)
+        if not self.enabled:
+            return(False)
+        with self.lock:
+            return(self.get_key(path) in self.file_sha)
+
+hash_cache = hash_cache_struct()
+
+class compress_route_struct:
+    # is_compressed of files decided by sampled contents (COMPRESS_ROUTING "sample").
+    # Decisions are kept by sha, so the same contents are not sampled again.
+    def __init__(self):
+        self.run_route = {}  # path:is_compressed decided in this run
+        self.sampled = {}  # path:is_compressed sampled in this run, to be stored by sha
+        self.sha_route = collections.OrderedDict()  # sha:is_compressed, oldest first
+        self.enabled = False
+        self.max_entries = 0
+
+    def load(self,fname,max_entries):
+        self.enabled = True
+        self.max_entries = max_entries
+        try:
+            with open(fname,"rb") as f:
+                self.sha_route = pickle.load(f)
+        except FileNotFoundError:
+            pass
+        except (OSError,EOFError,pickle.UnpicklingError):
+            logger.warning("Can not read compress route cache %s"%fname)
+
+    def save(self,fname):
+        if not self.enabled:
+            return
+        with open(fname + ".tmp","wb") as f:
+            pickle.dump(self.sha_route,f,protocol=pickle.HIGHEST_PROTOCOL)
+        os.replace(fname + ".tmp",fname)
+
+    def route(self,paths,file_stat):
+        # Decide paths not in NOCOMPRESS_EXTNSION and not smaller than COMPRESS_SAMPLE_MIN_SIZE.
+        # Returns (number of cached decisions,number of sampled files)
+        todo = []
+        cached = 0
+        for p in dict.fromkeys(paths):
+            if p in self.run_route or not is_file_to_compress(p):
+                continue
+            size = file_stat[p][0] if p in file_stat else -1
+            if 0 <= size < backup_config.COMPRESS_SAMPLE_MIN_SIZE:
+                continue
+            sha = hash_cache.get_known(p)
+            if sha is not None and sha in self.sha_route:
+                self.sha_route.move_to_end(sha)
+                self.run_route[p] = self.sha_route[sha]
+                cached += 1
+            else:
+                todo.append(p)
+        if backup_config.HASH_WORKERS > 1 and len(todo) > 1:
+            with concurrent.futures.ThreadPoolExecutor(max_workers=backup_config.HASH_WORKERS) as executor:
+                decisions = list(executor.map(is_compressible,todo))
+        else:
+            decisions = [is_compressible(p) for p in todo]
+        for p,d in zip(todo,decisions):
+            if d is not None:
+                self.run_route[p] = d
+                self.sampled[p] = d
+        return(cached,len(todo))
+
+    def store(self,run_sha):
+        # keep decisions of sampled files whose sha was calculated
+        for p,d in self.sampled.items():
+            sha = run_sha.get(p)
+            if sha is not None:
+                self.sha_route[sha] = d
+                self.sha_route.move_to_end(sha)
+        self.sampled = {}
+        if self.enabled:
+            while len(self.sha_route) > self.max_entries:
+                self.sha_route.popitem(last=False)
+
+compress_route = compress_route_struct()
+
+def is_compressible(path):
+    # Trial compression of COMPRESS_SAMPLE_BLOCKS blocks spread over the file by zlib level 1
+    # (zlib releases GIL). None if not readable.
+    block = backup_config.COMPRESS_SAMPLE_BLOCK_SIZE
+    n = backup_config.COMPRESS_SAMPLE_BLOCKS
+    raw = 0
+    packed = 0
+    try:
+        with open(path,"rb") as f:
+            size = os.fstat(f.fileno()).st_size
+            if size <= block*n:
+                offsets = [0]
+                block = size
+            else:
+                offsets = [(size-block)*i//(n-1) for i in range(n)] if n > 1 else [0]
+            for offset in offsets:
+                f.seek(offset)
+                data = f.read(block)
+                raw += len(data)
+                packed += len(zlib.compress(data,1))
+    except OSError:
+        return(None)
+    if raw == 0:
+        return(None)
+    return(packed < raw*backup_config.COMPRESS_SAMPLE_RATIO)
+
+def calc_hash_files(paths):
+    # Calculate sha of paths with backup_config.HASH_WORKERS threads (hashlib releases GIL).
+    # Each file is read at most once per run, results are kept in hash_cache.
+    # With the persistent cache enabled, files whose inode,size,mtime and ctime are known are not read.
+    # Returns {path:sha} in the order of paths. Files not permitted to read are not included.
+    run_sha = hash_cache.run_sha
+    todo = [p for p in dict.fromkeys(paths) if p not in run_sha]
+    if backup_config.HASH_WORKERS > 1 and len(todo) > 1:
+        with concurrent.futures.ThreadPoolExecutor(max_workers=backup_config.HASH_WORKERS) as executor:
+            digests = list(executor.map(hash_cache.calc_hash,todo))
+    else:
+        digests = [hash_cache.calc_hash(p) for p in todo]
+    for p,d in zip(todo,digests):
+        run_sha[p] = d
+    sha = {}
+    for p in paths:
+        if run_sha[p] is not None:
+            sha[p] = run_sha[p]
+    return(sha)
+
+def find_difference(p_mtime,p_sha,new_mtime,p_size=None,new_stat=None):
+    # With sizes (p_size {path:size or -1}, new_stat {path:(size,mtime_ns)}),
+    # files are not read when the size alone tells the answer.
+    # sha of such added files is None here, and calculated in make_archive_info_file.
+    if p_size is None or new_stat is None:
+        p_size = {}
+        new_stat = {}
     add_list = []
     update_list = []
     delete_list = []
-    move_list = []
     for path in new_mtime.keys():
         if path in p_mtime.keys():
-            if p_mtime[path] - new_mtime[path] > 2 or p_mtime[path] - new_mtime[path] < -1:
+            if is_modified(path,p_mtime,p_size,new_mtime,new_stat):
                 update_list.append(path)
         else:
             add_list.append(path)
-    print("Calculating hash for adding %d files"%len(add_list))
-    for p in add_list:
-        try:
-            add_sha[p] = calc_hash(p)
-        except PermissionError:
-            add_list.remove(p)
-    print("done")
     for path in p_mtime.keys():
         if path not in new_mtime.keys():
             delete_list.append(path)
-    delete_list2 = delete_list.copy()
-    for src_path in delete_list2:
-        src_sha = p_sha[src_path]
-        dst_sha_key = list(add_sha.keys())
-        dst_sha_val = list(add_sha.values())
-        if src_sha in dst_sha_val:
-            dst_path = dst_sha_key[dst_sha_val.index(p_sha[src_path])]
+    # only added files of the same size as some deleted file can be moved files.
+    deleted_size = set()
+    for path in delete_list:
+        deleted_size.add(p_size.get(path,-1))
+    if -1 in deleted_size:  # size unknown
+        move_candidates = add_list
+    else:
+        move_candidates = [p for p in add_list if p in new_stat and new_stat[p][0] in deleted_size]
+    print("Calculating hash for adding %d files"%len(move_candidates))
+    candidate_sha = calc_hash_files(move_candidates)
+    add_sha = {}
+    for path in add_list:
+        if path in candidate_sha:
+            add_sha[path] = candidate_sha[path]
+        elif path not in hash_cache.run_sha: # not hashed yet (None in run_sha is permission error)
+            add_sha[path] = None
+    print("done")
+    # contents of files whose size is changed are changed.
+    touch_candidates = [p for p in update_list if p_size.get(p,-1)<0 or p not in new_stat or p_size[p]==new_stat[p][0]]
+    print("Calculating hash for updated %d files"%len(touch_candidates))
+    update_sha = calc_hash_files(touch_candidates)
+    print("done")
+    touch_list = []  # only mtime is updated, contents are same as backuped
+    for path in update_sha.keys():
+        if update_sha[path] == p_sha[path]:
+            touch_list.append(path)
+    if len(touch_list)>0:
+        touched = set(touch_list)
+        update_list = [p for p in update_list if p not in touched]
+    move_list,delete_list = match_moved_files(p_sha,add_sha,delete_list)
+    return(add_sha,update_list,delete_list,move_list,touch_list)
+
+def is_modified(path,p_mtime,p_size,new_mtime,new_stat):
+    # mtime differs beyond the FAT resolution, or size differs
+    if p_mtime[path] - new_mtime[path] > 2 or p_mtime[path] - new_mtime[path] < -1:
+        return(True)
+    return(p_size.get(path,-1)>=0 and path in new_stat and p_size[path]!=new_stat[path][0])
+
+def match_moved_files(p_sha,add_sha,delete_list):
+    # A deleted file whose sha equals an added file is recorded as moved.
+    # If several files share a sha, deleted files (in delete_list order) take
+    # added files in add_sha order, one each. Matched added files are removed from add_sha.
+    added_by_sha = {}
+    for path,sha in add_sha.items():
+        if sha is None:
+            continue
+        if sha in added_by_sha:
+            added_by_sha[sha].append(path)
+        else:
+            added_by_sha[sha] = [path]
+    for sha in added_by_sha:
+        added_by_sha[sha].reverse() # pop() from the end gives add_sha order
+    move_list = []
+    remained_delete_list = []
+    for src_path in delete_list:
+        candidates = added_by_sha.get(p_sha[src_path])
+        if candidates:
+            dst_path = candidates.pop()
             move_list.append([src_path,dst_path])
-            delete_list.remove(src_path)
             add_sha.pop(dst_path)
             logger.debug("moved file %s -> %s"%(src_path,dst_path))
-    return(add_sha,update_list,delete_list,move_list)
+        else:
+            remained_delete_list.append(src_path)
+    return(move_list,remained_delete_list)
 
 def compress_char(path):
     if is_file_to_compress(path):
@@ -436,39 +1714,90 @@ def compress_char(path):
         type_char = "N"
     return(type_char)
 
-def make_archive_info_file(fname,mtime_dict,add_sha,update_list,delete_list,move_list):
+def make_archive_info_file(fname,mtime_dict,add_sha,update_list,delete_list,move_list,touch_list,stat_dict=None,archive_name=None):
+    if stat_dict is None:
+        stat_dict = {}
+    if archive_name is None:
+        archive_name = {}
     print("Making file list to backup.")
+    not_hashed = [p for p in list(add_sha.keys()) + update_list if p not in hash_cache.run_sha]
+    print("Calculating hash for %d files"%len(not_hashed))
+    calc_hash_files(not_hashed)
+    print("done")
+    for p in [p for p in add_sha.keys() if add_sha[p] is None]:
+        if hash_cache.run_sha[p] is None: # permission error
+            add_sha.pop(p)
+        else:
+            add_sha[p] = hash_cache.run_sha[p]
     f = open(fname,"wt",encoding="utf8")
-    f.write("### previous path(blank if new),new path(blank if delete),last modified,C=compress/N=non compress,sha value\n")
+    f.write(backup_config.ARCHIVE_FILE_INFO_HEADER)
     for p in add_sha.keys():
-        f.write(',"%s",%s,%s,%s\n'%(p,time2str(mtime_dict[p]),compress_char(p),bytes.hex(add_sha[p]).upper()))
-    print("Calculating hash for updated %d files"%len(update_list))
-    for p in update_list:
-        try:
-            h = bytes.hex(calc_hash(p)).upper()
-            f.write('"%s","%s",%s,%s,%s\n'%(p,p,time2str(mtime_dict[p]),compress_char(p),h))
-        except PermissionError:
-            logger.warning("Permission denied for %s"%p)
-    
-    print("done.")
+        f.write(format_fileinfo_line("",p,mtime_dict[p],compress_char(p),add_sha[p],stat_dict.get(p),archive_name.get(p,"")))
+    update_sha = calc_hash_files(update_list)
+    for p in update_sha.keys():
+        f.write(format_fileinfo_line(p,p,mtime_dict[p],compress_char(p),update_sha[p],stat_dict.get(p),archive_name.get(p,"")))
+    touch_sha = calc_hash_files(touch_list)
+    for p in touch_sha.keys():
+        f.write(format_fileinfo_line(p,p,mtime_dict[p],"M",touch_sha[p],stat_dict.get(p)))
     for p in delete_list:
-        f.write('"%s",,-1,%s,00\n'%(p,compress_char(p)))
+        f.write(format_fileinfo_line(p,"",None,compress_char(p),None))
+    move_sha = calc_hash_files([p[1] for p in move_list])
     for p in move_list:
-        try:
-            h = bytes.hex(calc_hash(p[1])).upper()
-            f.write('"%s","%s",%s,%s,%s\n'%(p[0],p[1],time2str(mtime_dict[p[1]]),compress_char(p[0]),h))
-        except PermissionError:
-            logger.warning("Permission denied for %s"%p[1])
+        if p[1] in move_sha:
+            f.write(format_fileinfo_line(p[0],p[1],mtime_dict[p[1]],compress_char(p[0]),move_sha[p[1]],stat_dict.get(p[1])))
     f.close()
 
+def assign_compress_shards(paths,stat_dict,n_shards):
+    # Returns {path:archive name} splitting paths into n_shards archives of about the same total size.
+    # Largest file first to the archive with the smallest total.
+    shard_size = [0]*n_shards
+    archive_name = {}
+    for p in sorted(paths,key=lambda p:stat_dict[p][0] if p in stat_dict else 0,reverse=True):
+        k = shard_size.index(min(shard_size))
+        shard_size[k] += stat_dict[p][0] if p in stat_dict else 0
+        archive_name[p] = backup_config.get_shard_archive_name(k)
+    return(archive_name)
+
+def find_stored_files(paths,content_index):
+    # Returns {path:DEDUP_ARCHIVE_NAME} of files whose contents are already stored in some archive,
+    # or in an earlier path of paths (stored once in this backup). paths are in the order of fileinfo.txt.
+    sha = calc_hash_files(paths)
+    archive_exists = {}
+    stored = set()
+    archive_name = {}
+    for p in paths:
+        if p not in sha: # permission error
+            continue
+        h = sha[p]
+        if h in stored or (h in content_index and is_stored_content_available(content_index[h],archive_exists)):
+            archive_name[p] = backup_config.DEDUP_ARCHIVE_NAME
+        else:
+            stored.add(h)
+    if len(archive_name) > 0:
+        print("%d files are already stored"%len(archive_name))
+    return(archive_name)
+
+def is_stored_content_available(entry,archive_exists):
+    # Refer only to archives still in the backup folder (not removed, not made by empty mode)
+    n,archive_name,is_compressed,path = entry
+    if archive_name == backup_config.CHUNK_ARCHIVE_NAME:
+        return(True)
+    archive_file = backup_config.ARCHIVE_FOLDER + n + backup_config.get_archive_name(is_compressed,archive_name) + backup_config.ARCHIVE_FILE_EXT
+    if archive_file not in archive_exists:
+        archive_exists[archive_file] = os.path.exists(archive_file)
+    return(archive_exists[archive_file])
+
 def make_backup_date_number(past_bk):
-    today = datetime.date.today().strftime("%Y%m%d")
-    for d in range(100):
-        bkname = today + "%02d"%d
-        if bkname not in past_bk.keys():
-            return(bkname)
+    # YYYYMMDDNN after the newest backup. Backups are replayed in the order of their numbers,
+    # so numbers left free below a consolidated backup must not be used.
+    bkname = datetime.date.today().strftime("%Y%m%d") + "00"
+    if len(past_bk) > 0 and max(past_bk.keys()) >= bkname:
+        bkname = "%010d"%(int(max(past_bk.keys())) + 1)
+    return(bkname)
 
 def is_file_to_compress(pathname):
+    if pathname in compress_route.run_route: # decided by contents
+        return(compress_route.run_route[pathname])
     ext = pathname.split(".")[-1].lower()
     if ext[-1]=='"':
         ext = ext[0:-1]            
@@ -477,52 +1806,281 @@ def is_file_to_compress(pathname):
     else:
         return(True)    
 
-def make_archive_list_for_7z(fname,nocomp_ext,compress_file,nocomp_file):
-    f = open(fname,encoding="utf8")
-    lines = f.read().split("\n")
-    f.close()
-    fnocomp = open(nocomp_file,"wt",encoding="utf8")
-    fcomp = open(compress_file,"wt",encoding="utf8")
-    nocomp = 0
-    comp = 0
-    for l in lines:
-        c = l.split(",")
-        if not len(c) == 5:
-            continue
-        prev_name = c[0]
-        pathname = c[1]
+def make_archive_list_for_7z(fname):
+    # Returns {archive name:[is_compressed,[quoted pathnames]]} of files to archive in fileinfo.txt
+    archive_list = {}
+    for prev_name,pathname,mtime,flag,sha,size,archive_name in read_fileinfo(fname):
         if (pathname == "") or ((not prev_name=="") and (not prev_name==pathname)):  # delete or move
             continue
-        if is_file_to_compress(pathname):
-            fcomp.write("%s\n"%pathname)
-            comp+=1
-        else:
-            fnocomp.write("%s\n"%pathname)
-            nocomp += 1
-    fnocomp.close()
-    fcomp.close()
-    return(comp,nocomp)
+        if flag == "M":  # mtime only
+            continue
+        is_compressed = (flag=="C" or flag=="c")
+        archive_name = backup_config.get_archive_name(is_compressed,archive_name)
+        if archive_name in ["/" + backup_config.CHUNK_ARCHIVE_NAME,"/" + backup_config.DEDUP_ARCHIVE_NAME]:
+            continue
+        if archive_name not in archive_list:
+            archive_list[archive_name] = [is_compressed,[]]
+        archive_list[archive_name][1].append('"%s"'%pathname)
+    return(archive_list)
 
-def verify():
+def run_7z_archive(archive_file,is_compressed,list_file_name,opt_7zip):
+    # returns (success,7z message)
+    reply = b''
+    try:
+        reply = subprocess.check_output([SEVEN_ZIP,"a",archive_file,"-mx1" if is_compressed else "-mx0","-v1g","@%s"%list_file_name]+opt_7zip)
+        return(True,reply.decode())
+    except subprocess.CalledProcessError:
+        print("Error occured while arhive %s"%archive_file)
+        return(False,"")
+    except UnicodeDecodeError:
+        print("UnicodeDecodeError occured in 7z message")
+        try:
+            print(reply)
+        except:
+            pass
+        return(True,"")
+
+def get_zip_archive_name(is_compressed,archive_name):
+    # comp_arch.zip for comp_arch.7z, comp_arch_1.zip for comp_arch_1.7z
+    base,ext = os.path.splitext(backup_config.get_archive_name(is_compressed,archive_name)[1:])
+    return(base + ".zip")
+
+def make_zip_archives(backup_number,paths,archive_name):
+    # Archive paths by the zip engine, ARCHIVE_JOBS archives at once. Archive of each path is put to archive_name.
+    # Returns True if all archives were made.
+    zip_list = {}  # archive name:[is_compressed,[paths]]
+    for p in paths:
+        is_compressed = is_file_to_compress(p)
+        name = get_zip_archive_name(is_compressed,archive_name.get(p,""))
+        archive_name[p] = name
+        if name not in zip_list:
+            zip_list[name] = [is_compressed,[]]
+        zip_list[name][1].append(p)
+    jobs = []
+    with concurrent.futures.ThreadPoolExecutor(max_workers=backup_config.ARCHIVE_JOBS) as executor:
+        for name in zip_list.keys():
+            is_compressed,files = zip_list[name]
+            print("%s %d files to %s"%("compressing" if is_compressed else "archiving",len(files),name))
+            jobs.append(executor.submit(run_zip_archive,backup_config.ARCHIVE_FOLDER + backup_number + "/" + name + backup_config.ARCHIVE_FILE_EXT,is_compressed,files))
+    success = True
+    for job in jobs:
+        ok,msg = job.result()
+        logger.debug(msg)
+        if not ok:
+            success = False
+    return(success)
+
+def run_zip_archive(archive_file,is_compressed,paths):
+    # returns (success,message) same as run_7z_archive. 7z extracts the zip file in restore.
+    try:
+        with zipfile.ZipFile(archive_file,"w",zipfile.ZIP_DEFLATED if is_compressed else zipfile.ZIP_STORED,allowZip64=True,compresslevel=1 if is_compressed else None) as zf: # same as 7z -mx1
+            for p in paths:
+                add_zip_member(zf,p)
+    except OSError as e:
+        print("Error occured while arhive %s"%archive_file)
+        return(False,str(e))
+    return(True,"%d files to %s"%(len(paths),archive_file))
+
+def add_zip_member(zf,path):
+    # Write path to zf calculating sha from the same data. sha is put to hash_cache.
+    key = hash_cache.get_key(path)
+    try:
+        fin = open(path,"rb")
+    except PermissionError:
+        logger.warning("Permission denied for %s"%path)
+        hash_cache.run_sha[path] = None
+        return
+    m = hashlib.sha256()
+    with fin:
+        st = os.fstat(fin.fileno())
+        zinfo = zipfile.ZipInfo.from_file(path,path,strict_timestamps=False)
+        zinfo.compress_type = zf.compression
+        set_zip_compress_level(zinfo,zf.compresslevel)
+        zinfo.extra = ntfs_time_extra(st)
+        with zf.open(zinfo,"w",force_zip64=st.st_size >= zipfile.ZIP64_LIMIT//2) as fout:
+            for chunk in iter(lambda: fin.read(1024*1024), b''):
+                m.update(chunk)
+                fout.write(chunk)
+    sha = m.digest()
+    hash_cache.run_sha[path] = sha
+    hash_cache.store(path,key,sha)
+
+def set_zip_compress_level(zinfo,level):
+    # ZipFile.open does not apply ZipFile.compresslevel to a given ZipInfo (level 6 is used).
+    # ZipInfo.compress_level is public from python 3.13, python 3.8-3.12 only have the private _compresslevel.
+    if hasattr(zipfile.ZipInfo,"compress_level"):
+        zinfo.compress_level = level
+    else:
+        zinfo._compresslevel = level
+
+def ntfs_time_extra(st):
+    # NTFS extra field of zip (mtime,atime,ctime in 100ns from 1601), restored by 7z in full precision
+    filetime = [t//100 + 116444736000000000 for t in [st.st_mtime_ns,st.st_atime_ns,st.st_ctime_ns]]
+    return(struct.pack("<HHIHH3Q",0x000a,32,0,0x0001,24,*filetime))
+
+# Content defined chunking. Each byte is mapped to one bit by CHUNK_BIT_TABLE, and a chunk ends
+# where the bits of the last CHUNK_PATTERN_BITS bytes equal CHUNK_PATTERN (searched by bytes.find).
+# Boundaries depend only on local contents, so an insertion or deletion changes only nearby chunks.
+CHUNK_BIT_TABLE = bytes([hashlib.sha256(b"incbackup chunk %d"%i).digest()[0] & 1 for i in range(256)])
+CHUNK_PATTERN = bytes([b & 1 for b in hashlib.sha256(b"incbackup chunk pattern").digest()])
+CHUNK_SCAN_STEP = 1024*1024
+
+def find_chunk_boundary(buf,min_size,max_size,pattern_bits):
+    # returns length of the first chunk in buf (buf is longer than max_size unless end of file)
+    if len(buf) <= min_size:
+        return(len(buf))
+    end = min(len(buf),max_size)
+    pattern = CHUNK_PATTERN[:pattern_bits]
+    pos = min_size - len(pattern)
+    while True:
+        stop = min(end,pos + CHUNK_SCAN_STEP)
+        i = buf[pos:stop].translate(CHUNK_BIT_TABLE).find(pattern)
+        if i >= 0:
+            return(pos + i + len(pattern))
+        if stop == end:
+            return(end)
+        pos = stop - len(pattern) + 1
+
+def iter_chunks(f,min_size,max_size,pattern_bits):
+    buf = b""
+    eof = False
+    while True:
+        if not eof and len(buf) < max_size:
+            data = f.read(max_size*4)
+            if len(data) == 0:
+                eof = True
+            buf += data
+        if len(buf) == 0:
+            return
+        if not eof and len(buf) < max_size:
+            continue
+        n = find_chunk_boundary(buf,min_size,max_size,pattern_bits)
+        yield(buf[:n])
+        buf = buf[n:]
+
+def get_chunk_file_name(chunk_folder,sha_hex):
+    return(chunk_folder + sha_hex[:2] + "/" + sha_hex)
+
+def get_chunk_manifest_name(chunk_folder,sha_hex):
+    return(chunk_folder + "manifest/" + sha_hex + ".txt")
+
+def write_file_atomic(fname,data):
+    os.makedirs(os.path.dirname(fname),exist_ok=True)
+    with open(fname + ".tmp","wb") as f:
+        f.write(data)
+    os.replace(fname + ".tmp",fname)
+
+def store_chunked_file(path,chunk_folder,is_compressed):
+    # Store path to the chunk store. Each chunk is stored once as chunks/xx/<sha of chunk> (zlib stream),
+    # and the list of chunks as chunks/manifest/<sha of file>.txt.
+    # Returns (sha of file,bytes written to chunk_folder)
+    m = hashlib.sha256()
+    manifest = []
+    written = 0
+    with open(path,"rb") as f:
+        for chunk in iter_chunks(f,backup_config.CHUNK_MIN_SIZE,backup_config.CHUNK_MAX_SIZE,backup_config.CHUNK_PATTERN_BITS):
+            m.update(chunk)
+            chunk_sha = hashlib.sha256(chunk).hexdigest().upper()
+            manifest.append("%s,%d\n"%(chunk_sha,len(chunk)))
+            chunk_file = get_chunk_file_name(chunk_folder,chunk_sha)
+            if not os.path.exists(chunk_file):
+                data = zlib.compress(chunk,1 if is_compressed else 0)
+                write_file_atomic(chunk_file,data)
+                written += len(data)
+    sha = m.digest()
+    manifest_file = get_chunk_manifest_name(chunk_folder,bytes.hex(sha).upper())
+    if not os.path.exists(manifest_file):
+        data = "".join(manifest).encode()
+        write_file_atomic(manifest_file,data)
+        written += len(data)
+    return(sha,written)
+
+def restore_chunked_file(sha,path,chunk_folder):
+    # Reassemble path from the manifest of sha
+    sha_hex = bytes.hex(sha).upper()
+    f = open(get_chunk_manifest_name(chunk_folder,sha_hex),encoding="utf8")
+    manifest = f.read().split("\n")
+    f.close()
+    m = hashlib.sha256()
+    with open(path + ".tmp","wb") as fout:
+        for l in manifest:
+            if l == "":
+                continue
+            chunk_sha,size = l.split(",")
+            with open(get_chunk_file_name(chunk_folder,chunk_sha),"rb") as fchunk:
+                chunk = zlib.decompress(fchunk.read())
+            if len(chunk) != int(size):
+                raise ValueError("broken chunk %s"%chunk_sha)
+            m.update(chunk)
+            fout.write(chunk)
+    if m.digest() != sha:
+        os.remove(path + ".tmp")
+        raise ValueError("sha of %s does not match"%path)
+    os.replace(path + ".tmp",path)
+
+def store_chunked_files(paths):
+    # Store large files to the chunk store. sha calculated while reading is put to hash_cache.
+    # Returns {path:archive name} of stored files.
+    archive_name = {}
+    written = 0
+    total = 0
+    for p in paths:
+        try:
+            sha,n = store_chunked_file(p,backup_config.CHUNK_FOLDER,is_file_to_compress(p))
+        except PermissionError:
+            logger.warning("Permission denied for %s"%p)
+            continue
+        hash_cache.run_sha[p] = sha
+        archive_name[p] = backup_config.CHUNK_ARCHIVE_NAME
+        written += n
+        total += os.stat(p).st_size
+    if len(paths) > 0:
+        print("chunk store: %d files %d bytes, %d bytes written"%(len(archive_name),total,written))
+    return(archive_name)
+
+def verify(quick=False,test_archives=False):
+    # Compare current files with the backup. quick: hash only files whose mtime or size differ from the backup.
+    # test_archives: also test archives and chunks. Results are written to VERIFY_SUMMARY_FILE_NAME as json.
+    summary = [verify_files(quick)]
+    if test_archives:
+        summary.append(verify_archives())
+    fname = backup_config.INDEX_FOLDER + backup_config.VERIFY_SUMMARY_FILE_NAME
+    with open(fname,"wt",encoding="utf8") as f:
+        json.dump(summary,f,indent=1,ensure_ascii=False)
+    print("verify %s. summary:%s"%("OK" if all([level["ok"] for level in summary]) else "NG",fname))
+
+def verify_files(quick):
+    start_time = time.time()
     prev_dir = os.getcwd()
     os.chdir(backup_config.src_top)
     print("Entered %s"%backup_config.src_top)
-    latest_backup_time = backuped_files.archive_time[sorted(backuped_files.archive_time.keys())[-1]]
-    current_mtime = search_target_file_and_get_mtime(backup_config.dst_top)
-    current_files = list(current_mtime.keys())
-    missing_files = []  # found in backup, but not in the current files
-    for f in backuped_files.file_sha.keys():
-        try :
-            if backuped_files.file_sha[f] != calc_hash(f):
-                print("\nWrong hash %s:%s %s"%(f,bytes.hex(backuped_files.file_sha[f]),bytes.hex(calc_hash(f))))
-            current_files.remove(f)
-#        except FileNotFoundError:
-        except ValueError:
-            missing_files.append(f)
+    latest_backup_number = sorted(backuped_files.archive_time.keys())[-1]
+    latest_backup_time = backuped_files.archive_time[latest_backup_number]
+    current_stat = {}
+    current_mtime = search_target_file_and_get_mtime(backup_config.dst_top,current_stat)
+    check_files = [f for f in backuped_files.file_sha.keys() if f in current_mtime]
+    skipped = 0
+    if quick:
+        modified_files = [f for f in check_files if is_modified(f,backuped_files.file_mtime,backuped_files.file_size,current_mtime,current_stat)]
+        skipped = len(check_files) - len(modified_files)
+        check_files = modified_files
+    print("Calculating hash for %d files"%len(check_files))
+    current_sha = calc_hash_files(check_files)
+    print("done")
+    wrong_files = []
+    unreadable_files = []
+    for f in check_files:
+        if f not in current_sha:
+            unreadable_files.append(f)
+        elif backuped_files.file_sha[f] != current_sha[f]:
+            print("\nWrong hash %s:%s %s"%(f,bytes.hex(backuped_files.file_sha[f]),bytes.hex(current_sha[f])))
+            wrong_files.append(f)
+    missing_files = [f for f in backuped_files.file_sha.keys() if f not in current_mtime]  # found in backup, but not in the current files
+    current_files = [f for f in current_mtime.keys() if f not in backuped_files.file_sha]  # found only in the current files
     print("")
+    untracked_files = []
+    unknown_files = []
     if len(current_files)>0:
-        untracked_files = []
-        unknown_files = []
         for f in current_files:
             if os.stat(f).st_ctime> latest_backup_time:
                 untracked_files.append(f)
@@ -544,74 +2102,166 @@ def verify():
     
     if len(missing_files)==0 and len(current_files)==0:
         print("All %d files were checked."%(len(backuped_files.file_sha)))
+        if skipped > 0:
+            print("%d files were not read, mtime and size are same as the backup."%skipped)
         print("")
     os.chdir(prev_dir)
+    return({
+        "level":"quick" if quick else "full",
+        "backup_number":latest_backup_number,
+        "files":len(backuped_files.file_sha),
+        "hashed":len(check_files),
+        "skipped":skipped,
+        "wrong_hash":wrong_files,
+        "unreadable":unreadable_files,
+        "missing":missing_files,
+        "unknown":unknown_files,
+        "untracked":len(untracked_files),
+        "ok":len(wrong_files)==0 and len(unreadable_files)==0 and len(missing_files)==0 and len(unknown_files)==0,
+        "sec":round(time.time()-start_time,2),
+        })
+
+def verify_archives():
+    # Test archives by "7z t" and chunks of the chunk store, ARCHIVE_JOBS at once.
+    start_time = time.time()
+    opt_7zip = []
+    if backup_config.password:
+        opt_7zip.append(backup_config.password)
+    archives = []
+    for n in sorted(backuped_files.archive_time.keys()):
+        for f in sorted(os.listdir(backup_config.ARCHIVE_FOLDER + n)):
+            if f.endswith(backup_config.ARCHIVE_FILE_EXT):
+                archives.append(backup_config.ARCHIVE_FOLDER + n + "/" + f)
+    chunks = []
+    if os.path.isdir(backup_config.CHUNK_FOLDER):
+        for d in sorted(os.listdir(backup_config.CHUNK_FOLDER)):
+            if len(d) == 2 and os.path.isdir(backup_config.CHUNK_FOLDER + d):
+                chunks += [backup_config.CHUNK_FOLDER + d + "/" + f for f in sorted(os.listdir(backup_config.CHUNK_FOLDER + d)) if not f.endswith(".tmp")]
+    print("Testing %d archives and %d chunks"%(len(archives),len(chunks)))
+    with concurrent.futures.ThreadPoolExecutor(max_workers=backup_config.ARCHIVE_JOBS) as executor:
+        archive_ok = list(executor.map(lambda a:test_7z_archive(a,opt_7zip),archives))
+        chunk_ok = list(executor.map(test_chunk_file,chunks))
+    failed = [a for a,ok in zip(archives,archive_ok) if not ok]
+    broken_chunks = [c for c,ok in zip(chunks,chunk_ok) if not ok]
+    for a in failed + broken_chunks:
+        print("Broken %s"%a)
+    return({
+        "level":"archives",
+        "archives":len(archives),
+        "chunks":len(chunks),
+        "failed":failed,
+        "broken_chunks":broken_chunks,
+        "ok":len(failed)==0 and len(broken_chunks)==0,
+        "sec":round(time.time()-start_time,2),
+        })
+
+def test_7z_archive(archive_file,opt_7zip):
+    try:
+        result = subprocess.run([SEVEN_ZIP,"t",archive_file]+opt_7zip,stdin=subprocess.DEVNULL,stdout=subprocess.PIPE,stderr=subprocess.STDOUT)
+    except OSError as e:
+        logger.warning("Can not run %s %s"%(SEVEN_ZIP,e))
+        return(False)
+    logger.debug(result.stdout)
+    return(result.returncode == 0)
+
+def test_chunk_file(fname):
+    try:
+        with open(fname,"rb") as f:
+            chunk = zlib.decompress(f.read())
+    except (OSError,zlib.error):
+        return(False)
+    return(hashlib.sha256(chunk).hexdigest().upper() == os.path.basename(fname))
 
 def backup(mode):
     backup_start_time = time.time()
     prev_dir = os.getcwd()
     os.chdir(backup_config.src_top)
-    current_mtime = search_target_file_and_get_mtime(backup_config.dst_top)
+    if len(backuped_files.replayed_archives)>0:
+        last_backup_number = backuped_files.replayed_archives[-1]
+    else:
+        last_backup_number = ""
+    journal_mark = change_journal.mark() if backup_config.USE_JOURNAL else None
+    current_stat = {}
+    current_mtime = None
+    if backup_config.USE_JOURNAL:
+        changed_paths = change_journal.read_changes(journal_mark,last_backup_number)
+        if changed_paths is None:
+            print("Journal does not cover changes after the last backup. Scan all folders.")
+        else:
+            current_mtime = search_changed_file_and_get_mtime(changed_paths,backuped_files.file_mtime,backuped_files.file_size,current_stat)
+    if current_mtime is None:
+        current_mtime = search_target_file_and_get_mtime(backup_config.dst_top,current_stat)
     print("Scan disk %.2f sec"%(time.time()-backup_start_time))
     backup_number = make_backup_date_number(backuped_files.archive_time)
 
-    # append , update , delete , modify
-    a,u,d,m = find_difference(backuped_files.file_mtime,backuped_files.file_sha,current_mtime)
+    # append , update , delete , modify , touch
+    a,u,d,m,t = find_difference(backuped_files.file_mtime,backuped_files.file_sha,current_mtime,backuped_files.file_size,current_stat)
 
-    if len(a)> 0 or len(d)>0 or len(m)>0 or len(u)>0:
+    if len(a)> 0 or len(d)>0 or len(m)>0 or len(u)>0 or len(t)>0:
         try:
             logging.info("create " + backup_config.ARCHIVE_FOLDER + backup_number)
             os.mkdir(backup_config.ARCHIVE_FOLDER + backup_number)
         except FileExistsError:
             pass
-        make_archive_info_file(backup_config.ARCHIVE_FOLDER + backup_number +"/"+backup_config.ARCHIVE_FILE_INFO_NAME,current_mtime,a,u,d,m)
-        opt_7zip = []
+        archive_name = {}
+        if mode=='backup' and backup_config.USE_CHUNK_STORE:
+            chunk_files = [p for p in list(a.keys())+u if p in current_stat and current_stat[p][0] >= backup_config.CHUNK_FILE_MIN_SIZE]
+            if backup_config.COMPRESS_ROUTING == "sample":
+                compress_route.route(chunk_files,current_stat)
+            archive_name = store_chunked_files(chunk_files)
+        if mode=='backup' and backup_config.USE_DEDUP:
+            dedup_candidates = [p for p in list(a.keys())+u if p not in archive_name]
+            if backup_config.ARCHIVE_ENGINE == "zip": # sha of the others is calculated while archiving
+                dedup_candidates = [p for p in dedup_candidates if hash_cache.is_known(p)]
+            archive_name.update(find_stored_files(dedup_candidates,backuped_files.content_index))
+        if mode=='backup' and backup_config.COMPRESS_ROUTING == "sample":
+            route_start_time = time.time()
+            cached,sampled = compress_route.route([p for p in list(a.keys())+u if p not in archive_name],current_stat)
+            print("Compression of %d files decided by samples, %d by cache %.2f sec"%(sampled,cached,time.time()-route_start_time))
+        if mode=='backup' and backup_config.COMPRESS_SHARDS > 1:
+            archive_name.update(assign_compress_shards([p for p in list(a.keys())+u if is_file_to_compress(p) and p not in archive_name],current_stat,backup_config.COMPRESS_SHARDS))
         arhive_sucess = True
+        if mode=='backup' and backup_config.ARCHIVE_ENGINE == "zip":
+            # shard names are turned into comp_arch_k.zip, only files of the chunk store and ref are not archived
+            arhive_sucess = make_zip_archives(backup_number,[p for p in list(a.keys())+u if archive_name.get(p) not in (backup_config.CHUNK_ARCHIVE_NAME,backup_config.DEDUP_ARCHIVE_NAME)],archive_name)
+        make_archive_info_file(backup_config.ARCHIVE_FOLDER + backup_number +"/"+backup_config.ARCHIVE_FILE_INFO_NAME,current_mtime,a,u,d,m,t,current_stat,archive_name)
+        compress_route.store(hash_cache.run_sha)
+        opt_7zip = []
         if backup_config.password:
             opt_7zip.append(backup_config.password)
-        if mode=='backup':
-            msg = ""
-            reply = b''
-            compress_file_name = backup_config.get_backup_temp_filename_comp(backup_number)
-            nocompress_file_name = backup_config.get_backup_temp_filename_nocomp(backup_number)
-            n_compress,n_nocom = make_archive_list_for_7z(backup_config.ARCHIVE_FOLDER + backup_number +"/"+backup_config.ARCHIVE_FILE_INFO_NAME,backup_config.NOCOMPRESS_EXTNSION,compress_file_name,nocompress_file_name)
-            if n_compress>0:
-                print("compressing %d files"%n_compress)
-                try:
-                    reply += subprocess.check_output([SEVEN_ZIP,"a", backup_config.ARCHIVE_FOLDER + backup_number +backup_config.ARCHIVE_FILE_COMPRESS,"-mx1","-v1g","@%s"%compress_file_name]+opt_7zip)
-                    msg += reply.decode()
-                except subprocess.CalledProcessError:
-                    print("Error occured while arhive")
-                    arhive_sucess = False
-                except UnicodeDecodeError:
-                    print("UnicodeDecodeError occured in 7z message")
-                    try:
-                        print(reply)
-                    except:
-                        pass
-            if n_nocom > 0:
-                print("archiving %d files"%n_nocom)
-                try:
-                    reply += subprocess.check_output([SEVEN_ZIP,"a",backup_config.ARCHIVE_FOLDER + backup_number +backup_config.ARCHIVE_FILE_NOCOMPRESS,"-mx0","-v1g","@%s"%nocompress_file_name]+opt_7zip)
-                    msg += reply.decode()
-                except subprocess.CalledProcessError:
-                    print("Error occured while arhive")
+        if mode=='backup' and backup_config.ARCHIVE_ENGINE == "7z":
+            archive_list = make_archive_list_for_7z(backup_config.ARCHIVE_FOLDER + backup_number +"/"+backup_config.ARCHIVE_FILE_INFO_NAME)
+            jobs = []
+            with concurrent.futures.ThreadPoolExecutor(max_workers=backup_config.ARCHIVE_JOBS) as executor:
+                for list_name in archive_list.keys():
+                    is_compressed,files = archive_list[list_name]
+                    list_file_name = backup_config.get_backup_temp_filename(backup_number,list_name)
+                    f = open(list_file_name,"wt",encoding="utf8")
+                    for p in files:
+                        f.write("%s\n"%p)
+                    f.close()
+                    print("%s %d files to %s"%("compressing" if is_compressed else "archiving",len(files),list_name[1:]))
+                    jobs.append((list_file_name,executor.submit(run_7z_archive,backup_config.ARCHIVE_FOLDER + backup_number + list_name,is_compressed,list_file_name,opt_7zip)))
+            for list_file_name,job in jobs:
+                success,msg = job.result()
+                logger.debug(msg)
+                if not success:
                     arhive_sucess = False
-                except UnicodeDecodeError:
-                    print("UnicodeDecodeError occured in 7z message")
-                    try:
-                        print(reply)
-                    except:
-                        pass
-            logger.debug(msg)
-            delete_temporary_file(compress_file_name)
-            delete_temporary_file(nocompress_file_name)
+                delete_temporary_file(list_file_name)
+        backup_time = write_archive_time(backup_config.ARCHIVE_FOLDER + backup_number)
         print("##############################################")
         if (backup_config.DELETE_ON_FAIL == True) and (arhive_sucess == False):
             shutil.rmtree(backup_config.ARCHIVE_FOLDER + backup_number)
             print("Backup failed.!!!!!!!!!!!!!!!!!!!!!!!!!")
             feedbackbeep(False)
         else:
+            if arhive_sucess:
+                backuped_files.archive_time[backup_number] = backup_time
+                changes = {}
+                backuped_files.apply_fileinfo(backup_number,backuped_files.get_fileinfo_data(backup_config.ARCHIVE_FOLDER,backup_config.ARCHIVE_FILE_INFO_NAME,backup_number),changes)
+                backuped_files.save_checkpoint(backup_config.ARCHIVE_FOLDER,backup_config.ARCHIVE_FILE_INFO_NAME,backup_config.INDEX_FOLDER)
+                add_backup_to_timeline(backup_number,changes)
+                change_journal.save_state(journal_mark,backup_number)
             if len(a) > 0:
                 print("added")
                 if len(a) > backup_config.PRINT_MAX_FILE_NUM:
@@ -640,9 +2290,19 @@ def backup(mode):
                 else:
                     for f in m:
                         print("  "+f[0]+"->"+f[1])
+            if len(t) > 0:
+                print("touched (mtime only)")
+                if len(t) > backup_config.PRINT_MAX_FILE_NUM:
+                    print("  %d files"%len(t))
+                else:
+                    for f in t:
+                        print("  "+f)
         print("##############################################")
     else:
         print("\n\nNothing to backup.")
+        if len(backuped_files.replayed_archives)>0 and backuped_files.checkpoint_number != backuped_files.replayed_archives[-1]:
+            backuped_files.save_checkpoint(backup_config.ARCHIVE_FOLDER,backup_config.ARCHIVE_FILE_INFO_NAME,backup_config.INDEX_FOLDER)
+        change_journal.save_state(journal_mark,last_backup_number)
     os.chdir(prev_dir)
 
 def restore(mode):
@@ -652,9 +2312,11 @@ def restore(mode):
         opt_7zip.append(backup_config.password)
 
     if mode=="restore":
+        # in the restore folder, so moving an extracted file is a rename
+        staging_folder = os.getcwd() + "/" + backup_config.RESTORE_STAGING_FOLDER_NAME
         try:
-            logging.info("create " + backup_config.MOVE_TEMP)
-            os.mkdir(backup_config.MOVE_TEMP)
+            logging.info("create " + staging_folder)
+            os.mkdir(staging_folder)
         except FileExistsError:
             pass
     if mode=="list":
@@ -666,131 +2328,462 @@ def restore(mode):
     if input("Restore/list continue OK? (Enter y) ").lower() != "y":
         return
 
-    for n in sorted(list(backuped_files.archive_time.keys())):
-        files_compress = []
-        files_nocompress = []
-        files_compress_move = []
-        files_nocompress_move = []
-        for p in backuped_files.file_mtime:
-            if backuped_files.file_archive_num[p] == n:
-                if len(recovery_files)==0 or p in recovery_files:
-                    if backuped_files.file_org_path[p] == False:
-                        if backuped_files.file_is_compressed[p]:
-                            files_compress.append(p)
-                        else:
-                            files_nocompress.append(p)
-                    else:
-                        if backuped_files.file_is_compressed[p]:
-                            files_compress_move.append(p)
-                        else:
-                            files_nocompress_move.append(p)
-        if mode=="restore": 
-            compress_file_name = backup_config.get_restore_temp_filename_comp(n)
-            nocompress_file_name = backup_config.get_restore_temp_filename_nocomp(n)
-            for is_file_moved in [False,True]:
-                for extrace_files, extract_list_name,archive_name in zip(
-                    ([files_compress_move,files_nocompress_move]if is_file_moved==True else [files_compress,files_nocompress]) ,
-                            [compress_file_name,nocompress_file_name], [backup_config.ARCHIVE_FILE_COMPRESS,backup_config.ARCHIVE_FILE_NOCOMPRESS]):
-##                    print(extrace_files)
-                    if len(extrace_files)>0:
-##                        print(extract_list_name)
-                        f = open(extract_list_name,"wt",encoding="utf8")
-                        for p in extrace_files:
-                            if is_file_moved:
-                                f.write('"%s"\n'%backuped_files.file_org_path[p])
-                            else:
-                                f.write('"%s"\n'%p)
-                        f.close()
-                        archive_file = backup_config.ARCHIVE_FOLDER + n + archive_name + backup_config.ARCHIVE_FILE_EXT
-                        try:
-                            os.stat(archive_file)
-                            try:
-#                                print(os.listdir())
-                                seven_zip_cmd = [SEVEN_ZIP,backup_config.EXTRACT_METHOD, archive_file,"@%s"%extract_list_name] + backup_config.OVERWRITE_OPT + opt_7zip
-                                print(archive_file)
-                                if is_file_moved:
-                                    seven_zip_cmd.append("-o"+backup_config.MOVE_TEMP)                                
-                                msg = subprocess.check_output(seven_zip_cmd).decode()
-                                logger.info(msg)
-                                if is_file_moved:
-                                    for p in extrace_files:
-                                        try:
-                                            create_path(p)
-                                            shutil.move(backup_config.MOVE_TEMP+ backuped_files.file_org_path[p],p) ####
-                                            print("shutil.mov %s,%s"%(backup_config.MOVE_TEMP+backuped_files.file_org_path[p],p))
-                                        except FileNotFoundError:
-                                            print("FileNotFoundError in moving %s->%s"%(backuped_files.file_org_path[p],p))
-                                delete_temporary_file(extract_list_name)
-                            except subprocess.CalledProcessError:
-                                print("7z error in %s.\nMay be same file exsit."%(archive_file))                                
-                        except FileNotFoundError:
-                            print(" not found." + archive_file + " skip.")
-        elif mode=="list":
-            for p in files_compress:
-                flist.write("%s,%s,C,%s\n"%(p,n,time2str(backuped_files.file_mtime[p])))
-            for p in files_nocompress:
-                flist.write("%s,%s,N,%s\n"%(p,n,time2str(backuped_files.file_mtime[p])))
-            for p in files_compress_move:
-                flist.write("%s,%s,C,%s\n <-%s\n"%(p,n,time2str(backuped_files.file_mtime[p]),backuped_files.file_org_path[p]))
-            for p in files_nocompress_move:
-                flist.write("%s,%s,N,%s\n <-%s\n"%(p,n,time2str(backuped_files.file_mtime[p]),backuped_files.file_org_path[p]))
+    restore_plan = make_restore_plan(recovery_files)
+    if mode=="restore":
+        # Each path is in the plan of only one backup number (its newest version),
+        # so backup numbers are extracted at once without conflict.
+        with concurrent.futures.ThreadPoolExecutor(max_workers=backup_config.RESTORE_JOBS) as executor:
+            jobs = [executor.submit(restore_backup_number,n,restore_plan[n][0],restore_plan[n][1],opt_7zip,staging_folder) for n in sorted(restore_plan.keys())]
+        for job in jobs:
+            job.result()
+    elif mode=="list":
+        for n in sorted(restore_plan.keys()):
+            files_direct,files_moved = restore_plan[n]
+            for is_compressed in [True,False]:
+                for p in files_direct:
+                    if backuped_files.file_is_compressed[p] == is_compressed:
+                        flist.write("%s,%s,%s,%s\n"%(p,n,"C" if is_compressed else "N",time2str(backuped_files.file_mtime[p])))
+            for is_compressed in [True,False]:
+                for p in files_moved:
+                    if backuped_files.file_is_compressed[p] == is_compressed:
+                        flist.write("%s,%s,%s,%s\n <-%s\n"%(p,n,"C" if is_compressed else "N",time2str(backuped_files.file_mtime[p]),backuped_files.file_org_path[p]))
     if mode=="restore":
-        unmoved_files = find_files(backup_config.MOVE_TEMP,[])
+        unmoved_files = find_files(staging_folder,[])
         if len(unmoved_files) > 0:
             logger.error("Unmoved files exist %s"%unmoved_files)
         else:
-            shutil.rmtree(backup_config.MOVE_TEMP)
+            shutil.rmtree(staging_folder)
     if mode=="list":
         flist.close()
 
+def restore_backup_number(n,files_direct,files_moved,opt_7zip,staging_folder):
+    # Extract files of backup number n.
+    # Moved files are extracted once for each original path to staging_folder/n/ (on the same file system),
+    # then renamed to the last path and copied to the others. Original paths restored directly are not extracted again.
+    move_temp = staging_folder + n + "/"
+    for p in files_direct+files_moved:
+        if backuped_files.file_archive_name[p] == backup_config.CHUNK_ARCHIVE_NAME:
+            restore_chunked_file_to(p)
+    moved_org_path = set([backuped_files.file_org_path[p] for p in files_moved])
+    existed = set()  # skipped by 7z, may be different from the backup
+    if backup_config.OVERWRITE_OPT == []:
+        existed = set([p for p in files_direct if p in moved_org_path and os.path.exists(p)])
+    for is_file_moved in [False,True]:
+        extract_files = {}  # archive name:[files]
+        for p in (files_moved if is_file_moved else files_direct):
+            if backuped_files.file_archive_name[p] == backup_config.CHUNK_ARCHIVE_NAME:
+                continue
+            archive_name = backup_config.get_archive_name(backuped_files.file_is_compressed[p],backuped_files.file_archive_name[p])
+            if archive_name not in extract_files:
+                extract_files[archive_name] = []
+            extract_files[archive_name].append(p)
+        if not is_file_moved:
+            direct_files = extract_files
+        for archive_name in sorted(extract_files.keys()):
+            extrace_files = extract_files[archive_name]
+            if is_file_moved:
+                restored = set(direct_files.get(archive_name,[])) - existed
+                members = [p for p in dict.fromkeys([backuped_files.file_org_path[p] for p in extrace_files]) if not (p in restored and os.path.exists(p))]
+            else:
+                members = extrace_files
+            extract_list_name = backup_config.get_restore_temp_filename(n,archive_name)
+            if len(members)>0:
+                f = open(extract_list_name,"wt",encoding="utf8")
+                for p in members:
+                    f.write('"%s"\n'%p)
+                f.close()
+                archive_file = backup_config.ARCHIVE_FOLDER + n + archive_name + backup_config.ARCHIVE_FILE_EXT
+                try:
+                    os.stat(archive_file)
+                    try:
+                        seven_zip_cmd = [SEVEN_ZIP,backup_config.EXTRACT_METHOD, archive_file,"@%s"%extract_list_name] + backup_config.OVERWRITE_OPT + opt_7zip
+                        print(archive_file)
+                        if is_file_moved:
+                            seven_zip_cmd.append("-o"+move_temp)
+                        if backup_config.RESTORE_JOBS > 1 and backup_config.OVERWRITE_OPT == []:
+                            seven_zip_cmd.append("-aos") # skip existing files, 7z can not ask while other 7z run
+                        msg = subprocess.check_output(seven_zip_cmd,stdin=subprocess.DEVNULL if backup_config.RESTORE_JOBS > 1 else None).decode()
+                        logger.info(msg)
+                        delete_temporary_file(extract_list_name)
+                    except subprocess.CalledProcessError:
+                        print("7z error in %s.\nMay be same file exsit."%(archive_file))                                
+                        continue
+                except FileNotFoundError:
+                    print(" not found." + archive_file + " skip.")
+                    continue
+            if is_file_moved:
+                extracted = set(members)
+                # the last file of each original path takes the extracted file
+                remained = collections.Counter([backuped_files.file_org_path[p] for p in extrace_files])
+                for p in extrace_files:
+                    org_path = backuped_files.file_org_path[p]
+                    src = move_temp + org_path if org_path in extracted else org_path
+                    try:
+                        create_path(p)
+                        remained[org_path] -= 1
+                        if remained[org_path] > 0 or src == org_path:
+                            copy_restored_file(src,p)
+                        else:
+                            os.replace(src,p)
+                        print("%s -> %s"%(src,p))
+                    except FileNotFoundError:
+                        print("FileNotFoundError in moving %s->%s"%(src,p))
+
+def copy_restored_file(src,dst):
+    # Copy sharing the data blocks (reflink) where the file system supports it.
+    # With --hardlink, make a hard link instead. Otherwise a normal copy.
+    if backup_config.RESTORE_HARDLINK:
+        try:
+            if os.path.exists(dst):
+                os.remove(dst)
+            os.link(src,dst)
+            return
+        except OSError:
+            pass
+    if fcntl is not None:
+        try:
+            with open(src,"rb") as fsrc, open(dst,"wb") as fdst:
+                fcntl.ioctl(fdst.fileno(),FICLONE,fsrc.fileno())
+            shutil.copystat(src,dst)
+            return
+        except OSError:
+            pass
+    shutil.copy2(src,dst)
+
+def make_restore_plan(recovery_files):
+    # Group files to restore by backup number in one pass.
+    # Returns {backup number:[files extracted to their path,files extracted from file_org_path and moved]}
+    # recovery_files are looked up directly. All files if empty.
+    if len(recovery_files)==0:
+        files = backuped_files.file_mtime.keys()
+    else:
+        files = []
+        for p in dict.fromkeys(recovery_files):
+            if p in backuped_files.file_archive_num:
+                files.append(p)
+            else:
+                print("%s is not in the backup. skip."%p)
+    restore_plan = {}
+    for p in files:
+        n = backuped_files.file_archive_num[p]
+        if n not in restore_plan:
+            restore_plan[n] = [[],[]]
+        if backuped_files.file_org_path[p] == False:
+            restore_plan[n][0].append(p)
+        else:
+            restore_plan[n][1].append(p)
+    return(restore_plan)
+
+def restore_chunked_file_to(p,dst=None):
+    if dst is None:
+        dst = p
+    if os.path.exists(dst) and backup_config.OVERWRITE_OPT == []:
+        print("%s exists. skip."%dst)
+        return
+    create_path(dst)
+    try:
+        restore_chunked_file(backuped_files.file_sha[p],dst,backup_config.CHUNK_FOLDER)
+        print(dst)
+    except (OSError,ValueError) as e:
+        print("Error in restoring %s from chunk store. %s"%(dst,e))
+        return
+    os.utime(dst,(backuped_files.file_mtime[p],backuped_files.file_mtime[p]))
+
 def history():
+    # Extract all versions of files to path/backup_number. -f takes files, folders (all files under them)
+    # and prefixes ending with *. Versions are extracted with one 7z for each archive, RESTORE_JOBS archives at once.
     recovery_files = backup_config.recovery_files.copy()
     opt_7zip = []
     if backup_config.password:
         opt_7zip.append(backup_config.password)
 
-    try:
-        logging.info("create " + backup_config.MOVE_TEMP)
-        os.mkdir(backup_config.MOVE_TEMP)
-    except FileExistsError:
-        pass
-
     print("Current directory is %s"%os.getcwd())
     if input("Make history continue OK? (Enter y) ").lower() != "y":
         return
 
-    for p in recovery_files:
-        create_path(strip_double_quote(p)+"/dummy")
+    targets = set([p for p in recovery_files if not p.endswith("*")])
+    prefixes = tuple([p[:-1] for p in recovery_files if p.endswith("*")])
+    staging_folder = os.getcwd() + "/" + backup_config.RESTORE_STAGING_FOLDER_NAME
+
+    index = open_timeline()
+    if index is not None:
+        versions = index.get_versions(targets,prefixes)
+    else:
+        versions = scan_history_versions(targets,prefixes)
+    extract_plan = {}  # (backup number,archive name):[(path in archive,destination)]
+    chunk_plan = []  # (sha,destination)
+    for p,n,sha,src_n,archive_name,is_compressed,src_path in versions:
+        if archive_name == backup_config.DEDUP_ARCHIVE_NAME: # stored contents not found
+            continue
+        dst = p + '/%s'%n
+        if os.path.exists(dst) and backup_config.OVERWRITE_OPT == []:
+            print("%s exists. skip."%dst)
+            continue
+        if archive_name == backup_config.CHUNK_ARCHIVE_NAME:
+            chunk_plan.append((sha,dst))
+            continue
+        key = (src_n,backup_config.get_archive_name(is_compressed,archive_name))
+        if key not in extract_plan:
+            extract_plan[key] = []
+        extract_plan[key].append((src_path,dst))
+
+    print("%d versions in %d archives, %d versions in chunk store"%(sum([len(v) for v in extract_plan.values()]),len(extract_plan),len(chunk_plan)))
+    with concurrent.futures.ThreadPoolExecutor(max_workers=backup_config.RESTORE_JOBS) as executor:
+        jobs = [executor.submit(extract_versions,n,archive_name,extract_plan[(n,archive_name)],opt_7zip,staging_folder) for n,archive_name in sorted(extract_plan.keys())]
+        jobs += [executor.submit(restore_chunked_version,sha,dst) for sha,dst in chunk_plan]
+    for job in jobs:
+        job.result()
+    if os.path.isdir(staging_folder):
+        unmoved_files = find_files(staging_folder,[])
+        if len(unmoved_files) > 0:
+            logger.error("Unmoved files exist %s"%unmoved_files)
+        else:
+            shutil.rmtree(staging_folder)
 
+def scan_history_versions(targets,prefixes):
+    # same as timeline_struct.get_versions, reading fileinfo.txt of all backups
+    content_index = {}  # same as backuped_files_struct.content_index, to find contents of ref
     for n in sorted(list(backuped_files.archive_time.keys())):
-        f = open(backup_config.ARCHIVE_FOLDER+n+"/"+backup_config.ARCHIVE_FILE_INFO_NAME ,encoding="utf8")
-        lines = f.read().split('\n')
-        f.close()
-        for l in lines[1:]: ## skip 1st line (comment line)
-            c = split_including_commma(l)
-            if len(c)<5:
+        for prev_name,recover_file_name,mtime,flag,sha,size,archive_name in read_fileinfo(backup_config.ARCHIVE_FOLDER+n+"/"+backup_config.ARCHIVE_FILE_INFO_NAME):
+            if recover_file_name == "":  # delete
+                continue
+            if prev_name != "" and prev_name!=recover_file_name:  # move 
+                continue
+            if flag=="M":  # mtime only, same data as previous version
                 continue
 
-            if strip_double_quote(c[1]) in recovery_files:
-                if c[0] != "" and c[0]!=c[1]:  # move 
+            sha = bytes.fromhex(sha)
+            if archive_name == backup_config.DEDUP_ARCHIVE_NAME:
+                if sha not in content_index:
                     continue
+                src_n,archive_name,is_compressed,src_path = content_index[sha]
+            else:
+                src_n,is_compressed,src_path = n,(flag=="C" or flag=="c"),recover_file_name
+                content_index[sha] = (src_n,archive_name,is_compressed,src_path)
 
-                recover_file_name = strip_double_quote(c[1])
-                if c[3]=="C":
-                    archive_file = backup_config.ARCHIVE_FOLDER + n + backup_config.ARCHIVE_FILE_COMPRESS + backup_config.ARCHIVE_FILE_EXT
-                else:
-                    archive_file = backup_config.ARCHIVE_FOLDER + n + backup_config.ARCHIVE_FILE_NOCOMPRESS + backup_config.ARCHIVE_FILE_EXT
-                try:
-                    os.stat(archive_file)
-                except FileNotFoundError:
-                    continue
+            if is_history_target(recover_file_name,targets,prefixes):
+                yield((recover_file_name,n,sha,src_n,archive_name,is_compressed,src_path))
 
-                seven_zip_cmd = [SEVEN_ZIP,"e", archive_file] + backup_config.OVERWRITE_OPT + opt_7zip + [recover_file_name]
+def is_history_target(path,targets,prefixes):
+    # path is in targets, under a folder in targets, or starts with one of prefixes
+    if path in targets or (len(prefixes)>0 and path.startswith(prefixes)):
+        return(True)
+    folder = path
+    while "/" in folder:
+        folder = folder[:folder.rindex("/")]
+        if folder in targets:
+            return(True)
+    return(False)
 
-                msg = subprocess.check_output(seven_zip_cmd).decode()
-                logger.debug(msg)
-                dst = recover_file_name + '/%s'%n
-                shutil.move(os.path.basename(recover_file_name),dst) 
+def extract_versions(n,archive_name,versions,opt_7zip,staging_folder):
+    # Extract [(path in archive,destination)] from one archive by one 7z, then rename to the destinations.
+    archive_file = backup_config.ARCHIVE_FOLDER + n + archive_name + backup_config.ARCHIVE_FILE_EXT
+    if not os.path.exists(archive_file):
+        print(" not found." + archive_file + " skip.")
+        return
+    staging = staging_folder + n + "_" + os.path.basename(archive_name) + "/"
+    list_file_name = backup_config.get_restore_temp_filename("h" + n,archive_name)
+    members = collections.Counter([src_path for src_path,dst in versions])
+    f = open(list_file_name,"wt",encoding="utf8")
+    for p in members.keys():
+        f.write('"%s"\n'%p)
+    f.close()
+    seven_zip_cmd = [SEVEN_ZIP,backup_config.EXTRACT_METHOD,archive_file,"@%s"%list_file_name,"-o"+staging,"-aoa"] + opt_7zip
+    print(archive_file)
+    try:
+        msg = subprocess.check_output(seven_zip_cmd,stdin=subprocess.DEVNULL).decode()
+        logger.debug(msg)
+    except subprocess.CalledProcessError:
+        print("7z error in %s."%(archive_file))
+        return
+    finally:
+        delete_temporary_file(list_file_name)
+    for src_path,dst in versions:
+        try:
+            create_path(dst)
+            members[src_path] -= 1
+            if members[src_path] > 0:
+                copy_restored_file(staging + src_path,dst)
+            else:
+                os.replace(staging + src_path,dst)
+        except FileNotFoundError:
+            print("FileNotFoundError in moving %s->%s"%(src_path,dst))
+
+def restore_chunked_version(sha,dst):
+    create_path(dst)
+    try:
+        restore_chunked_file(sha,dst,backup_config.CHUNK_FOLDER)
+    except (OSError,ValueError) as e:
+        print("Error in restoring %s from chunk store. %s"%(dst,e))
+
+def consolidate(upto):
+    # Merge backups up to backup number upto into one backup of number upto, which has only
+    # the files existing at upto (and contents referred by ref of later backups).
+    # The new backup is made in CONSOLIDATE_FOLDER_NAME, then replaced by finish_consolidation.
+    numbers = sorted(backuped_files.archive_time.keys())
+    if upto is None and len(numbers) > 0:
+        upto = numbers[-1]
+    if upto not in numbers:
+        print("backup %s not found"%upto)
+        return
+    old_numbers = [n for n in numbers if n <= upto]
+    if len(old_numbers) < 2:
+        print("Nothing to consolidate.")
+        return
+    print("Consolidate %d backups %s - %s"%(len(old_numbers),old_numbers[0],upto))
+    if input("Backups are replaced. continue OK? (Enter y) ").lower() != "y":
+        return
+    opt_7zip = []
+    if backup_config.password:
+        opt_7zip.append(backup_config.password)
+
+    state = backuped_files_struct()
+    state.archive_time = dict([(n,backuped_files.archive_time[n]) for n in old_numbers])
+    state.reconstruct_incremental(backup_config.ARCHIVE_FOLDER,backup_config.ARCHIVE_FILE_INFO_NAME,backup_config.INDEX_FOLDER)
+    referred = set()  # sha of ref in later backups
+    for n in numbers[len(old_numbers):]:
+        for prev_name,pathname,mtime,flag,sha,size,archive_name in state.get_fileinfo_data(backup_config.ARCHIVE_FOLDER,backup_config.ARCHIVE_FILE_INFO_NAME,n):
+            if archive_name == backup_config.DEDUP_ARCHIVE_NAME:
+                referred.add(bytes.fromhex(sha))
+
+    work = backup_config.ARCHIVE_FOLDER + backup_config.CONSOLIDATE_FOLDER_NAME
+    if os.path.isdir(work): # left by a failed consolidation
+        shutil.rmtree(work)
+    os.makedirs(work + "base/")
+    os.makedirs(work + "files/")
+
+    lines = [backup_config.ARCHIVE_FILE_INFO_HEADER]
+    extract_plan = {}  # (backup number,archive name):[(path in archive,path in the new archive)]
+    archive_files = {True:[],False:[]}  # is_compressed:[paths in the new archive]
+    archive_exists = {}
+    stored = set()
+    missing = 0
+    def add_content(p,sha,entry):
+        # returns archive column of p in the new fileinfo.txt
+        n,archive_name,is_compressed,src_path = entry
+        if sha in stored:
+            return(backup_config.DEDUP_ARCHIVE_NAME)
+        if archive_name == backup_config.CHUNK_ARCHIVE_NAME:
+            stored.add(sha)
+            return(archive_name)
+        if not is_stored_content_available(entry,archive_exists):
+            return(backup_config.MISSING_ARCHIVE_NAME)
+        key = (n,backup_config.get_archive_name(is_compressed,archive_name))
+        if key not in extract_plan:
+            extract_plan[key] = []
+        extract_plan[key].append((src_path,p))
+        archive_files[is_compressed].append(p)
+        stored.add(sha)
+        return("")
+    for p in state.file_mtime.keys():
+        sha = state.file_sha[p]
+        is_compressed = state.file_is_compressed[p]
+        src_path = state.file_org_path[p] if state.file_org_path[p] != False else p
+        archive_name = add_content(p,sha,(state.file_archive_num[p],state.file_archive_name[p],is_compressed,src_path))
+        if archive_name == backup_config.MISSING_ARCHIVE_NAME:
+            missing += 1
+        st = (state.file_size[p],round(state.file_mtime[p]*1e9)) if state.file_size[p] >= 0 else None # approximate mtime_ns
+        lines.append(format_fileinfo_line("",p,state.file_mtime[p],"C" if is_compressed else "N",sha,st,archive_name))
+    for sha in referred:
+        if sha in stored or sha not in state.content_index:
+            continue
+        # contents no longer existing at upto, stored as a file added and deleted
+        p = backup_config.CONSOLIDATE_CONTENT_FOLDER_NAME + bytes.hex(sha).upper()
+        is_compressed = state.content_index[sha][2]
+        archive_name = add_content(p,sha,state.content_index[sha])
+        if archive_name == backup_config.MISSING_ARCHIVE_NAME:
+            continue
+        lines.append(format_fileinfo_line("",p,time.time(),"C" if is_compressed else "N",sha,None,archive_name))
+        lines.append(format_fileinfo_line(p,"",None,"C" if is_compressed else "N",None))
+    if missing > 0:
+        print("%d files are not in archives (backup by empty mode or removed archive)"%missing)
+
+    for n,archive_name in sorted(extract_plan.keys()):
+        archive_file = backup_config.ARCHIVE_FOLDER + n + archive_name + backup_config.ARCHIVE_FILE_EXT
+        staging = work + "extract/" + n + "_" + os.path.basename(archive_name) + "/"
+        list_file_name = backup_config.get_restore_temp_filename("c" + n,archive_name)
+        f = open(list_file_name,"wt",encoding="utf8")
+        for src_path,p in extract_plan[(n,archive_name)]:
+            f.write('"%s"\n'%src_path)
+        f.close()
+        print(archive_file)
+        msg = subprocess.check_output([SEVEN_ZIP,backup_config.EXTRACT_METHOD,archive_file,"@%s"%list_file_name,"-o"+staging,"-aoa"]+opt_7zip,stdin=subprocess.DEVNULL).decode()
+        logger.debug(msg)
+        delete_temporary_file(list_file_name)
+        for src_path,p in extract_plan[(n,archive_name)]:
+            create_path(work + "files/" + p)
+            os.replace(staging + src_path,work + "files/" + p)
+        shutil.rmtree(staging)
+
+    prev_dir = os.getcwd()
+    os.chdir(work + "files/")
+    try:
+        for is_compressed in [True,False]:
+            if len(archive_files[is_compressed]) == 0:
+                continue
+            archive_name = backup_config.get_archive_name(is_compressed)
+            list_file_name = backup_config.get_backup_temp_filename("c" + upto,archive_name)
+            f = open(list_file_name,"wt",encoding="utf8")
+            for p in archive_files[is_compressed]:
+                f.write('"%s"\n'%p)
+            f.close()
+            print("%s %d files to %s"%("compressing" if is_compressed else "archiving",len(archive_files[is_compressed]),archive_name[1:]))
+            success,msg = run_7z_archive(work + "base" + archive_name,is_compressed,list_file_name,opt_7zip)
+            logger.debug(msg)
+            delete_temporary_file(list_file_name)
+            if not success:
+                print("Consolidation failed. Backups are not changed.")
+                return
+    finally:
+        os.chdir(prev_dir)
+    f = open(work + "base/" + backup_config.ARCHIVE_FILE_INFO_NAME,"wt",encoding="utf8")
+    f.write("".join(lines))
+    f.flush()
+    os.fsync(f.fileno())
+    f.close()
+    write_archive_time(work + "base",backuped_files.archive_time[upto])
+
+    # commit point. From here finish_consolidation completes the replacement even after a crash.
+    marker = backup_config.INDEX_FOLDER + backup_config.CONSOLIDATE_MARKER_NAME
+    with open(marker + ".tmp","wt",encoding="utf8") as f:
+        f.write("%s,%d\n"%(upto,os.stat(backup_config.ARCHIVE_FOLDER + upto).st_mtime_ns))
+        for n in old_numbers:
+            f.write("%s\n"%n)
+        f.flush()
+        os.fsync(f.fileno())
+    os.replace(marker + ".tmp",marker)
+    finish_consolidation()
+    print("%d backups were consolidated to %s. %d files."%(len(old_numbers),upto,len(state.file_mtime)))
+
+def finish_consolidation():
+    # Replace backups listed in CONSOLIDATE_MARKER_NAME by the consolidated one. Safe to run again after a crash.
+    marker = backup_config.INDEX_FOLDER + backup_config.CONSOLIDATE_MARKER_NAME
+    if not os.path.exists(marker):
+        return
+    f = open(marker,encoding="utf8")
+    lines = f.read().split("\n")
+    f.close()
+    upto,mtime_ns = lines[0].split(",")
+    old_numbers = [n for n in lines[1:] if n != ""]
+    work = backup_config.ARCHIVE_FOLDER + backup_config.CONSOLIDATE_FOLDER_NAME
+    base_moved = not os.path.isdir(work + "base/")
+    os.makedirs(work + "old/",exist_ok=True)
+    for n in old_numbers:
+        if n == upto and base_moved: # already replaced
+            continue
+        if os.path.isdir(backup_config.ARCHIVE_FOLDER + n):
+            os.replace(backup_config.ARCHIVE_FOLDER + n,work + "old/" + n)
+    if not base_moved:
+        os.replace(work + "base/",backup_config.ARCHIVE_FOLDER + upto)
+    os.utime(backup_config.ARCHIVE_FOLDER + upto,ns=(int(mtime_ns),int(mtime_ns))) # keep the time of the backup
+    for f in os.listdir(backup_config.INDEX_FOLDER):
+        if f.startswith(backup_config.STATE_INDEX_PREFIX) and f.endswith(backup_config.STATE_INDEX_EXT): # made from the old backups
+            os.remove(backup_config.INDEX_FOLDER + f)
+        elif f.startswith(backup_config.TIMELINE_FILE_NAME): # with -journal
+            os.remove(backup_config.INDEX_FOLDER + f)
+    shutil.rmtree(work)
+    os.remove(marker)
+    logger.info("consolidation to %s finished"%upto)
 
 def parse_command():
 #    global backup_config
@@ -806,11 +2799,27 @@ def parse_command():
     parser.add_argument('--full_path', action="store_true", help='full path')
     parser.add_argument('--delete_on_fail', action="store_true", help='delete archive if some error happends')
     parser.add_argument('--silent', action="store_true", help='No beep when finished')
+    parser.add_argument('--hash_workers', type=int, help='number of threads to calculate sha (1:no thread)')
+    parser.add_argument('--no_hash_cache', action="store_true", help='always read files to calculate sha')
+    parser.add_argument('--no_timeline', action="store_true", help='replay all fileinfo.txt for -t and history instead of the timeline index')
+    parser.add_argument('--archive_jobs', type=int, help='number of 7z processes run at once')
+    parser.add_argument('--restore_jobs', type=int, help='number of backup folders extracted at once in restore')
+    parser.add_argument('--hardlink', action="store_true", help='restore files of the same contents as hard links')
+    parser.add_argument('--compress_shards', type=int, help='split files to compress into this number of archives')
+    parser.add_argument('--chunk_store', action="store_true", help='store large files in deduplicated chunks')
+    parser.add_argument('--engine', choices=["7z","zip"], help='7z(default) or zip, archive in this process reading each file once')
+    parser.add_argument('--no_dedup', action="store_true", help='archive files even if the same contents are stored')
+    parser.add_argument('--compress_routing', choices=["extension","sample"], help='extension(default) or sample, compress files whose sampled blocks shrink')
+    parser.add_argument('--journal', action="store_true", help='find changed files from the journal of watch mode')
+    parser.add_argument('--scan_workers', type=int, help='number of threads to read directories (1:no thread)')
+    parser.add_argument('--quick', action="store_true", help='verify only files whose mtime or size differ from the backup')
+    parser.add_argument('--archives', action="store_true", help='verify also tests archives by 7z t')
+    parser.add_argument('--upto', help='consolidate backups up to this backup number (default is the last)')
     parser.add_argument('-f','--recovery_files', nargs='+', help='specify files or @file_list to recover')
     args = parser.parse_args() #,action="store_true"
 
     if (len(sys.argv)==1) or (not args.mode) or (not args.backup_top):
-        print("Usage incbackup.py backup|empty|restore|list|verify dst_root -opts file1 file2 @fileslist")
+        print("Usage incbackup.py backup|empty|restore|list|verify|watch|consolidate dst_root -opts file1 file2 @fileslist")
         print("In restore mode,restore files to current directory")
         print(" -p password")
         print(" -t YYYY/MM/DD-HH:MM:SS restore to this time point.")
@@ -819,8 +2828,8 @@ def parse_command():
 #        print("In verify mode, type incbackup.py verify /media/usr/usbdisk/info_only_folder")
         exit(1)
     mode = args.mode
-    if mode not in ["backup","empty","restore","list","history","verify"]:
-        print("mode must be backup|empty|restore|list|history")
+    if mode not in ["backup","empty","restore","list","history","verify","watch","consolidate"]:
+        print("mode must be backup|empty|restore|list|history|verify|watch|consolidate")
         exit(1)
 
     dst_root = args.backup_top
@@ -836,6 +2845,13 @@ def parse_command():
     except FileNotFoundError:
         logging.info("create " +backup_config.ARCHIVE_FOLDER)
         os.mkdir(backup_config.ARCHIVE_FOLDER)
+    backup_config.INDEX_FOLDER = dst_root + backup_config.INDEX_FOLDER_NAME
+    backup_config.CHUNK_FOLDER = dst_root + backup_config.CHUNK_FOLDER_NAME
+    try:
+        os.listdir(backup_config.INDEX_FOLDER)
+    except FileNotFoundError:
+        logging.info("create " +backup_config.INDEX_FOLDER)
+        os.mkdir(backup_config.INDEX_FOLDER)
 
     if args.password :
         backup_config.password = "-p"+args.password
@@ -857,6 +2873,46 @@ def parse_command():
         backup_config.DELETE_ON_FAIL = True
     if args.silent:
         backup_config.DO_BEEP = False
+    if args.hash_workers:
+        backup_config.HASH_WORKERS = max(1,args.hash_workers)
+    if args.archive_jobs:
+        backup_config.ARCHIVE_JOBS = max(1,args.archive_jobs)
+    if args.restore_jobs:
+        backup_config.RESTORE_JOBS = max(1,args.restore_jobs)
+    if args.hardlink:
+        backup_config.RESTORE_HARDLINK = True
+    if args.compress_shards:
+        backup_config.COMPRESS_SHARDS = max(1,args.compress_shards)
+    if args.chunk_store:
+        if args.password:
+            print("--chunk_store can not be used with password. Chunks are not encrypted.")
+        else:
+            backup_config.USE_CHUNK_STORE = True
+    if args.engine == "zip":
+        if args.password:
+            print("--engine zip can not be used with password. Use 7z.")
+        elif sys.version_info < (3,8):
+            print("--engine zip needs python 3.8 or later. Use 7z.")
+        else:
+            backup_config.ARCHIVE_ENGINE = "zip"
+    if args.upto:
+        backup_config.CONSOLIDATE_UPTO = args.upto
+    if args.quick:
+        backup_config.VERIFY_QUICK = True
+    if args.archives:
+        backup_config.VERIFY_ARCHIVES = True
+    if args.no_dedup:
+        backup_config.USE_DEDUP = False
+    if args.compress_routing:
+        backup_config.COMPRESS_ROUTING = args.compress_routing
+    if args.journal:
+        backup_config.USE_JOURNAL = True
+    if args.scan_workers:
+        backup_config.SCAN_WORKERS = max(1,args.scan_workers)
+    if args.no_hash_cache:
+        backup_config.USE_HASH_CACHE = False
+    if args.no_timeline:
+        backup_config.USE_TIMELINE = False
     if args.wait_sec: ## w5 w1.5
         backup_config.WAIT_SEC_BEFORE_EXIT = float(args.wait_sec)
     if args.config_file:
@@ -872,7 +2928,7 @@ def parse_command():
                 f.close()
                 for l in lines:
                     if l != "":                
-                        backup_config.recovery_files.append(get_proper_pathname(recover_file))
+                        backup_config.recovery_files.append(get_proper_pathname(l))
             else:
                 backup_config.recovery_files.append(get_proper_pathname(recover_file))
 
@@ -885,7 +2941,7 @@ def parse_command():
         
     backup_config.read_config_files(backup_config_files)
 
-    if mode=="backup" or mode=="restore" or mode=="list" or mode=="history" :
+    if mode=="backup" or mode=="restore" or mode=="list" or mode=="history" or mode=="consolidate" :
         try:
             create_path(backup_config.WORKDIR)
         except FileExistsError:
@@ -893,7 +2949,7 @@ def parse_command():
 
     backup_config.RESTORE_LIST_FILE = backup_config.WORKDIR + backup_config.RESTORE_LIST_FILE
 
-    backup_config.BACKUP_STOP_FOLDER = list(backup_config.dst_top.keys())
+    backup_config.BACKUP_STOP_FOLDER = set(backup_config.dst_top.keys())
     for f in backup_config.BACKUP_STOP_FOLDER:
         if backup_config.dst_top[f] in [[".+"],[".*"]]:
             backup_config.dst_top.pop(f)
@@ -909,26 +2965,45 @@ if __name__ == '__main__':
     try:
         backup_config = parse_command()    
         ref_time = time.time()
+        change_journal = change_journal_struct(backup_config.INDEX_FOLDER)
     
+        finish_consolidation()
         backuped_files = create_backup_file_obj(backup_config.ARCHIVE_FOLDER,backup_config.RECOVERY_TIME)
-        if backup_config.mode=="history":
+        if backup_config.mode=="watch":
+            watch()
+        elif backup_config.mode=="history":
             history()
+        elif backup_config.mode=="consolidate":
+            consolidate(backup_config.CONSOLIDATE_UPTO)
         else:
-            backuped_files.reconstruct_incremental(backup_config.ARCHIVE_FOLDER,backup_config.ARCHIVE_FILE_INFO_NAME )
+            index = open_timeline() if backup_config.RECOVERY_TIME >= 0 else None
+            if index is not None: # state at -t from the timeline index, without replay
+                backuped_files.replayed_archives = sorted(backuped_files.archive_time.keys())
+                backuped_files.checkpoint_number = None
+                if len(backuped_files.replayed_archives) > 0:
+                    index.load_state(backuped_files,backuped_files.replayed_archives[-1],backup_config.recovery_files)
+            else:
+                backuped_files.reconstruct_incremental(backup_config.ARCHIVE_FOLDER,backup_config.ARCHIVE_FILE_INFO_NAME,backup_config.INDEX_FOLDER)
     
             print("Reconstruct %.2f sec"%(time.time()-ref_time))
+            if backup_config.USE_HASH_CACHE and backup_config.mode in ["backup","empty","verify"]:
+                hash_cache.load(backup_config.INDEX_FOLDER+backup_config.HASH_CACHE_FILE_NAME,backup_config.HASH_CACHE_MAX_ENTRIES)
+            if backup_config.COMPRESS_ROUTING == "sample" and backup_config.mode == "backup":
+                compress_route.load(backup_config.INDEX_FOLDER+backup_config.COMPRESS_ROUTE_CACHE_FILE_NAME,backup_config.COMPRESS_ROUTE_CACHE_MAX_ENTRIES)
             if backup_config.mode == "backup" or backup_config.mode=="empty":
                 backup(backup_config.mode)
             elif backup_config.mode=="restore" or backup_config.mode=="list":
                 restore(backup_config.mode)
             elif backup_config.mode=="verify" :
-                verify()
+                verify(backup_config.VERIFY_QUICK,backup_config.VERIFY_ARCHIVES)
+            hash_cache.save(backup_config.INDEX_FOLDER+backup_config.HASH_CACHE_FILE_NAME)
+            compress_route.save(backup_config.INDEX_FOLDER+backup_config.COMPRESS_ROUTE_CACHE_FILE_NAME)
     
         print("total %.2f sec"%(time.time()-ref_time))
         feedbackbeep(True)
         time.sleep(backup_config.WAIT_SEC_BEFORE_EXIT)
-        if backup_config.mode=="backup" or backup_config.mode=="restore" or backup_config.mode=="list" or backup_config.mode=="history" :
-            if not backup_config.mode=="backup":
+        if backup_config.mode=="backup" or backup_config.mode=="restore" or backup_config.mode=="list" or backup_config.mode=="history" or backup_config.mode=="consolidate" :
+            if not backup_config.mode in ["backup","consolidate"]:
                 input("Hit ret to erase %s"%backup_config.WORKDIR)
             shutil.rmtree(backup_config.WORKDIR)
 